@@ -1,62 +1,286 @@
-import timm  # noqa
+import hashlib
+import importlib
+import json
+import logging
+import os
+import time
+
 import torch
-import torchvision.models as models  # noqa
 
-def load_ref_wrn50():
-    
-    import resnet 
-    return resnet.wide_resnet50_2(True)
+LOGGER = logging.getLogger(__name__)
+
+
+class _Factory:
+    """Builds a backbone, importing its library only when it is selected.
+
+    Keys starting with one of ignored_prefixes are dropped from weights
+    files, for parts of the network the built module leaves out.
+    """
+
+    def __init__(self, module, build, ignored_prefixes=()):
+        self.module = module
+        self.build = build
+        self.ignored_prefixes = tuple(ignored_prefixes)
+
+
+def _torchvision(name):
+    return _Factory("torchvision.models", lambda models, pretrained: getattr(models, name)(pretrained=pretrained))
+
+
+def _timm(name):
+    return _Factory("timm", lambda timm, pretrained: timm.create_model(name, pretrained=pretrained))
+
 
 _BACKBONES = {
-    "cait_s24_224" : "cait.cait_S24_224(True)",
-    "cait_xs24": "cait.cait_XS24(True)",
-    "alexnet": "models.alexnet(pretrained=True)",
-    "bninception": 'pretrainedmodels.__dict__["bninception"]'
-    '(pretrained="imagenet", num_classes=1000)',
-    "resnet18": "models.resnet18(pretrained=True)",
-    "resnet50": "models.resnet50(pretrained=True)",
-    "mc3_resnet50": "load_mc3_rn50()", 
-    "resnet101": "models.resnet101(pretrained=True)",
-    "resnext101": "models.resnext101_32x8d(pretrained=True)",
-    "resnet200": 'timm.create_model("resnet200", pretrained=True)',
-    "resnest50": 'timm.create_model("resnest50d_4s2x40d", pretrained=True)',
-    "resnetv2_50_bit": 'timm.create_model("resnetv2_50x3_bitm", pretrained=True)',
-    "resnetv2_50_21k": 'timm.create_model("resnetv2_50x3_bitm_in21k", pretrained=True)',
-    "resnetv2_101_bit": 'timm.create_model("resnetv2_101x3_bitm", pretrained=True)',
-    "resnetv2_101_21k": 'timm.create_model("resnetv2_101x3_bitm_in21k", pretrained=True)',
-    "resnetv2_152_bit": 'timm.create_model("resnetv2_152x4_bitm", pretrained=True)',
-    "resnetv2_152_21k": 'timm.create_model("resnetv2_152x4_bitm_in21k", pretrained=True)',
-    "resnetv2_152_384": 'timm.create_model("resnetv2_152x2_bit_teacher_384", pretrained=True)',
-    "resnetv2_101": 'timm.create_model("resnetv2_101", pretrained=True)',
-    "vgg11": "models.vgg11(pretrained=True)",
-    "vgg19": "models.vgg19(pretrained=True)",
-    "vgg19_bn": "models.vgg19_bn(pretrained=True)",
-    "wideresnet50": "models.wide_resnet50_2(pretrained=True)",
-    "ref_wideresnet50": "load_ref_wrn50()",
-    "wideresnet101": "models.wide_resnet101_2(pretrained=True)",
-    "mnasnet_100": 'timm.create_model("mnasnet_100", pretrained=True)',
-    "mnasnet_a1": 'timm.create_model("mnasnet_a1", pretrained=True)',
-    "mnasnet_b1": 'timm.create_model("mnasnet_b1", pretrained=True)',
-    "densenet121": 'timm.create_model("densenet121", pretrained=True)',
-    "densenet201": 'timm.create_model("densenet201", pretrained=True)',
-    "inception_v4": 'timm.create_model("inception_v4", pretrained=True)',
-    "vit_small": 'timm.create_model("vit_small_patch16_224", pretrained=True)',
-    "vit_base": 'timm.create_model("vit_base_patch16_224", pretrained=True)',
-    "vit_large": 'timm.create_model("vit_large_patch16_224", pretrained=True)',
-    "vit_r50": 'timm.create_model("vit_large_r50_s32_224", pretrained=True)',
-    "vit_deit_base": 'timm.create_model("deit_base_patch16_224", pretrained=True)',
-    "vit_deit_distilled": 'timm.create_model("deit_base_distilled_patch16_224", pretrained=True)',
-    "vit_swin_base": 'timm.create_model("swin_base_patch4_window7_224", pretrained=True)',
-    "vit_swin_large": 'timm.create_model("swin_large_patch4_window7_224", pretrained=True)',
-    "efficientnet_b7": 'timm.create_model("tf_efficientnet_b7", pretrained=True)',
-    "efficientnet_b5": 'timm.create_model("tf_efficientnet_b5", pretrained=True)',
-    "efficientnet_b3": 'timm.create_model("tf_efficientnet_b3", pretrained=True)',
-    "efficientnet_b1": 'timm.create_model("tf_efficientnet_b1", pretrained=True)',
-    "efficientnetv2_m": 'timm.create_model("tf_efficientnetv2_m", pretrained=True)',
-    "efficientnetv2_l": 'timm.create_model("tf_efficientnetv2_l", pretrained=True)',
-    "efficientnet_b3a": 'timm.create_model("efficientnet_b3a", pretrained=True)',
+    "cait_s24_224": _timm("cait_s24_224"),
+    "cait_xs24": _timm("cait_xs24_384"),
+    "alexnet": _torchvision("alexnet"),
+    "bninception": _Factory(
+        "pretrainedmodels",
+        lambda pretrainedmodels, pretrained: pretrainedmodels.__dict__["bninception"](
+            pretrained="imagenet" if pretrained else None, num_classes=1000
+        ),
+    ),
+    "resnet18": _torchvision("resnet18"),
+    "resnet50": _torchvision("resnet50"),
+    "resnet101": _torchvision("resnet101"),
+    "resnext101": _torchvision("resnext101_32x8d"),
+    "resnet200": _timm("resnet200"),
+    "resnest50": _timm("resnest50d_4s2x40d"),
+    "resnetv2_50_bit": _timm("resnetv2_50x3_bitm"),
+    "resnetv2_50_21k": _timm("resnetv2_50x3_bitm_in21k"),
+    "resnetv2_101_bit": _timm("resnetv2_101x3_bitm"),
+    "resnetv2_101_21k": _timm("resnetv2_101x3_bitm_in21k"),
+    "resnetv2_152_bit": _timm("resnetv2_152x4_bitm"),
+    "resnetv2_152_21k": _timm("resnetv2_152x4_bitm_in21k"),
+    "resnetv2_152_384": _timm("resnetv2_152x2_bit_teacher_384"),
+    "resnetv2_101": _timm("resnetv2_101"),
+    "vgg11": _torchvision("vgg11"),
+    "vgg19": _torchvision("vgg19"),
+    "vgg19_bn": _torchvision("vgg19_bn"),
+    "wideresnet50": _torchvision("wide_resnet50_2"),
+    # resnet.py leaves out the classification head of torchvision checkpoints.
+    "ref_wideresnet50": _Factory(
+        "resnet", lambda resnet, pretrained: resnet.wide_resnet50_2(pretrained), ignored_prefixes=("fc.",)
+    ),
+    "wideresnet101": _torchvision("wide_resnet101_2"),
+    "mnasnet_100": _timm("mnasnet_100"),
+    "mnasnet_a1": _timm("mnasnet_a1"),
+    "mnasnet_b1": _timm("mnasnet_b1"),
+    "densenet121": _timm("densenet121"),
+    "densenet201": _timm("densenet201"),
+    "inception_v4": _timm("inception_v4"),
+    "vit_small": _timm("vit_small_patch16_224"),
+    "vit_base": _timm("vit_base_patch16_224"),
+    "vit_large": _timm("vit_large_patch16_224"),
+    "vit_r50": _timm("vit_large_r50_s32_224"),
+    "vit_deit_base": _timm("deit_base_patch16_224"),
+    "vit_deit_distilled": _timm("deit_base_distilled_patch16_224"),
+    "vit_swin_base": _timm("swin_base_patch4_window7_224"),
+    "vit_swin_large": _timm("swin_large_patch4_window7_224"),
+    "efficientnet_b7": _timm("tf_efficientnet_b7"),
+    "efficientnet_b5": _timm("tf_efficientnet_b5"),
+    "efficientnet_b3": _timm("tf_efficientnet_b3"),
+    "efficientnet_b1": _timm("tf_efficientnet_b1"),
+    "efficientnetv2_m": _timm("tf_efficientnetv2_m"),
+    "efficientnetv2_l": _timm("tf_efficientnetv2_l"),
+    "efficientnet_b3a": _timm("efficientnet_b3a"),
 }
 
+_LOADED = {}
+# Weight files whose checksum was verified in this process.
+_VERIFIED = set()
+
+
+class WeightStore:
+    """Local directory of backbone weights for machines without internet.
+
+    manifest.json maps backbone names to a state_dict file in the store,
+    together with its size and sha256 checksum.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def __contains__(self, name):
+        return name in self.manifest
+
+    @staticmethod
+    def _sha256(path):
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as weights_file:
+            for chunk in iter(lambda: weights_file.read(2**20), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def path(self, name, verify=False):
+        """Returns the weights file of name, checking its size (and checksum if verify).
+
+        A checksum is computed only once per process and file.
+        """
+        entry = self.manifest[name]
+        path = os.path.join(self.root, entry["file"])
+        if os.path.getsize(path) != entry["size"]:
+            raise ValueError("Size of {} does not match the manifest.".format(path))
+        key = (os.path.abspath(path), entry["sha256"])
+        if verify and key not in _VERIFIED:
+            if self._sha256(path) != entry["sha256"]:
+                raise ValueError("Checksum of {} does not match the manifest.".format(path))
+            _VERIFIED.add(key)
+        return path
+
+    def add(self, name, state_dict):
+        """Stores state_dict as the weights of name."""
+        os.makedirs(self.root, exist_ok=True)
+        filename = name + ".pth"
+        path = os.path.join(self.root, filename)
+        torch.save(state_dict, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.manifest[name] = {
+            "file": filename,
+            "size": os.path.getsize(path),
+            "sha256": self._sha256(path),
+        }
+        with open(self.manifest_path + ".tmp", "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+
+def load_state_dict_file(path):
+    """Loads a state_dict on the CPU, memory-mapped where torch supports it.
+
+    Memory-mapped tensors are backed by the page cache, so processes that
+    load the same file share its pages instead of each holding a copy.
+    Returns the state_dict and whether it is memory-mapped.
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True), True
+    except (TypeError, RuntimeError):
+        # torch < 2.1 or a file in the legacy (non-zip) format.
+        return torch.load(path, map_location="cpu"), False
+
+
+def _build_from_file(factory, module, weights_path):
+    """Builds a backbone whose parameters are the tensors stored in weights_path.
+
+    The (memory-mapped) tensors are assigned as they are instead of being
+    copied into the freshly initialized parameters. Loading is strict,
+    apart from the ignored_prefixes of the factory.
+    """
+    backbone = factory.build(module, False)
+    state_dict, backbone.weights_mmap = load_state_dict_file(weights_path)
+    if factory.ignored_prefixes:
+        state_dict = {
+            key: value for key, value in state_dict.items()
+            if not key.startswith(factory.ignored_prefixes)
+        }
+    try:
+        backbone.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        # torch < 2.1
+        backbone.load_state_dict(state_dict)
+        backbone.weights_mmap = False
+    return backbone
+
+
+def _weights_path(name, weights_path=None, weight_store=None, verify=False):
+    """Returns the weights file load() takes name from, None if they are downloaded."""
+    if isinstance(weight_store, str):
+        weight_store = WeightStore(weight_store)
+    if weights_path is None and weight_store is not None and name in weight_store:
+        weights_path = weight_store.path(name, verify)
+    return None if weights_path is None else os.path.abspath(weights_path)
+
+
+def load(name, weights_path=None, weight_store=None, verify=False):
+    """Builds backbone name.
+
+    Weights are taken from weights_path if given, else from weight_store
+    (a WeightStore or its directory) if it holds name, else downloaded by
+    the backbone's library.
+    """
+    if name not in _BACKBONES:
+        raise ValueError(
+            "Unknown backbone {}, choose one of {}.".format(name, sorted(_BACKBONES))
+        )
+    weights_path = _weights_path(name, weights_path, weight_store, verify)
+
+    factory = _BACKBONES[name]
+    start = time.perf_counter()
+    module = importlib.import_module(factory.module)
+    imported = time.perf_counter()
+    if weights_path is None:
+        backbone = factory.build(module, True)
+        backbone.weights_mmap = False
+    else:
+        backbone = _build_from_file(factory, module, weights_path)
+    built = time.perf_counter()
+    LOGGER.info(
+        "Loaded backbone {}: import {:.2f}s, build {:.2f}s{}.".format(
+            name, imported - start, built - imported,
+            " (memory-mapped weights)" if backbone.weights_mmap else "",
+        )
+    )
+    return backbone
+
+
+def export_to_store(name, weight_store):
+    """Downloads the pretrained weights of name into weight_store."""
+    if isinstance(weight_store, str):
+        weight_store = WeightStore(weight_store)
+    weight_store.add(name, load(name).state_dict())
+
+
+def get(name, seed=None, weights_path=None, weight_store=None, verify=False):
+    """Returns backbone name, loaded only once per process, seed and weights file.
+
+    verify checks the checksum of weights taken from weight_store. The
+    weights file (None for downloaded weights) is kept as weights_path of
+    the backbone.
+
+    The same frozen module is handed to every caller, copy it before
+    training it.
+    """
+    weights_path = _weights_path(name, weights_path, weight_store, verify)
+    key = (name, seed, weights_path)
+    if key not in _LOADED:
+        backbone = load(name, weights_path)
+        backbone.name, backbone.seed, backbone.weights_path = name, seed, weights_path
+        _LOADED[key] = backbone.requires_grad_(False)
+    return _LOADED[key]
+
+
+def share_memory():
+    """Moves the weights of all backbones loaded by get() to shared memory.
+
+    Memory-mapped weights are skipped, forked processes already share
+    their pages.
+    """
+    for backbone in _LOADED.values():
+        if not backbone.weights_mmap:
+            backbone.share_memory()
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.group()
+    def main():
+        pass
+
+    @main.command("export")
+    @click.argument("weight_store", type=click.Path(file_okay=False))
+    @click.option("--backbone_names", "-b", type=str, multiple=True, required=True)
+    def export(weight_store, backbone_names):
+        """Downloads backbone weights into a local weight store."""
+        for name in backbone_names:
+            export_to_store(name, weight_store)
+            LOGGER.info("Stored {} in {}.".format(name, weight_store))
 
-def load(name):
-    return eval(_BACKBONES[name])
+    logging.basicConfig(level=logging.INFO)
+    main()
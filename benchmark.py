@@ -0,0 +1,558 @@
+"""Micro-benchmarks for the hot spots of the SimpleNet pipeline.
+
+Every command measures one component in isolation on synthetic inputs
+shaped like the run.sh configuration (wideresnet50, layer2+layer3, 288px).
+
+    python benchmark.py backbone -b wideresnet50 -le layer2 -le layer3
+"""
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+import scipy.ndimage as ndimage
+import torch
+
+import backbones
+import common
+import metrics
+import resnet
+import simplenet
+import utils
+from datasets import mvtec
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _time_call(fn, repeats, warmup=1):
+    """Returns the mean wall-clock time of fn() in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def _peak_memory_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is reported in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def _synthetic_segmentations(n_images, imagesize, seed=0):
+    """Returns smooth anomaly maps and box-shaped masks they partially cover."""
+    rng = np.random.RandomState(seed)
+    amaps = ndimage.gaussian_filter(
+        rng.rand(n_images, imagesize, imagesize).astype(np.float32), (0, 4, 4)
+    )
+    masks = np.zeros_like(amaps)
+    for mask, amap in zip(masks, amaps):
+        for _ in range(rng.randint(0, 3)):
+            y, x = rng.randint(0, imagesize * 3 // 4, 2)
+            h, w = rng.randint(4, imagesize // 4, 2)
+            mask[y:y + h, x:x + w] = 1
+            amap[y:y + h, x:x + w] += 0.05
+    return masks, amaps
+
+
+def _run_isolated(fn, *args):
+    """Runs fn in a fresh process so that peak memory is not shared."""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def _backbone_worker(backbone_name, layers, truncate, imagesize, batch_size, repeats, device):
+    device = torch.device(device)
+    # Not kept in a variable, so that "prune" releases the pruned weights.
+    aggregator = common.NetworkFeatureAggregator(
+        backbones.load(backbone_name), layers, device, truncate=truncate
+    ).eval()
+    images = torch.randn(batch_size, 3, imagesize, imagesize, device=device)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    memory_before = _peak_memory_mb(device)
+
+    def step():
+        aggregator(images)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    latency = _time_call(step, repeats)
+    return latency, memory_before, _peak_memory_mb(device)
+
+
+def _embedding_net(engine, layers, imagesize, device, seed=0):
+    """Returns a SimpleNet on a randomly initialized wideresnet50 and per-layer features of a batch."""
+    torch.manual_seed(seed)
+    net = simplenet.SimpleNet(device)
+    net.load(
+        resnet.wide_resnet50_2(False), layers, device, (3, imagesize, imagesize),
+        pretrain_embed_dimension=1536, target_embed_dimension=1536, pre_proj=1,
+        embed_engine=engine,
+    )
+    return net
+
+
+def _embed_worker(engine, layers, imagesize, batch_size, repeats, device):
+    device = torch.device(device)
+    net = _embedding_net(engine, layers, imagesize, device)
+    engine = net.embedding_engine
+    features = engine.extract(
+        torch.randn(batch_size, 3, imagesize, imagesize, device=device), evaluation=True
+    )
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    memory_before = _peak_memory_mb(device)
+
+    def step():
+        with torch.no_grad():
+            engine.embed_features(features, project=True)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    latency = _time_call(step, repeats)
+    memory_peak = _peak_memory_mb(device)
+    stage_times = engine.add_timing_hook(common.StageTimes())
+    _time_call(step, repeats, warmup=0)
+    return latency, memory_before, memory_peak, stage_times.summary()
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command("backbone")
+@click.option("--backbone_name", "-b", type=str, default="wideresnet50", show_default=True)
+@click.option("--layers_to_extract_from", "-le", type=str, multiple=True, default=["layer2", "layer3"], show_default=True)
+@click.option("--imagesize", type=int, default=288, show_default=True)
+@click.option("--batch_size", type=int, default=8, show_default=True)
+@click.option("--repeats", type=int, default=10, show_default=True)
+@click.option("--device", type=str, default="cpu", show_default=True)
+def backbone(backbone_name, layers_to_extract_from, imagesize, batch_size, repeats, device):
+    """Per-batch latency and peak memory of NetworkFeatureAggregator per truncation mode."""
+    layers = list(layers_to_extract_from)
+    print(f"{backbone_name} {layers} batch={batch_size} size={imagesize} device={device}")
+    for truncate in ["none", "exit", "prune"]:
+        latency, memory_before, memory_peak = _run_isolated(
+            _backbone_worker, backbone_name, layers, truncate, imagesize, batch_size, repeats, device
+        )
+        print(
+            f"truncate={truncate:5s} latency:{latency:9.1f}ms"
+            f"  memory after load:{memory_before:8.1f}MB  peak:{memory_peak:8.1f}MB"
+        )
+
+
+@main.command("pro")
+@click.option("--n_images", type=int, default=30, show_default=True)
+@click.option("--imagesize", type=int, default=288, show_default=True)
+@click.option("--num_th", type=int, default=200, show_default=True)
+def pro(n_images, imagesize, num_th):
+    """Time of the vectorized compute_pro against the per-threshold reference loop.
+
+    Their agreement is tested in tests/test_metrics.py.
+    """
+    masks, amaps = _synthetic_segmentations(n_images, imagesize)
+    results = {}
+    for name, fn in [("legacy", metrics.compute_pro_legacy), ("vectorized", metrics.compute_pro)]:
+        start = time.perf_counter()
+        results[name] = fn(masks, amaps, num_th=num_th)
+        print(f"{name:10s} pro:{results[name]:.10f}  time:{time.perf_counter() - start:8.3f}s")
+    print(f"abs diff: {abs(results['legacy'] - results['vectorized']):.3e}")
+
+
+@main.command("pixel_auroc")
+@click.option("--n_images", type=int, default=30, show_default=True)
+@click.option("--imagesize", type=int, default=288, show_default=True)
+@click.option("--batch_size", type=int, default=8, show_default=True)
+@click.option("--num_bins", "-n", type=int, multiple=True, default=[2**12, 2**16, 2**20], show_default=True)
+def pixel_auroc(n_images, imagesize, batch_size, num_bins):
+    """Streaming PixelMetricAccumulator against the exact pixel-wise metrics."""
+    masks, amaps = _synthetic_segmentations(n_images, imagesize)
+    start = time.perf_counter()
+    exact = metrics.compute_pixelwise_retrieval_metrics(amaps, masks)["auroc"]
+    print(f"exact        auroc:{exact:.10f}  time:{time.perf_counter() - start:8.3f}s")
+    for bins in num_bins:
+        start = time.perf_counter()
+        accumulator = metrics.PixelMetricAccumulator(bins)
+        for i in range(0, n_images, batch_size):
+            accumulator.update(amaps[i:i + batch_size], masks[i:i + batch_size])
+        result = accumulator.compute()
+        print(
+            f"bins={bins:<8d} auroc:{result['auroc']:.10f}  time:{time.perf_counter() - start:8.3f}s"
+            f"  error:{abs(result['auroc'] - exact):.3e}  bound:{result['auroc_error_bound']:.3e}"
+            f"  state:{(accumulator.positives.nbytes + accumulator.negatives.nbytes) / 2**20:.1f}MB"
+        )
+
+
+@main.command("normalization")
+@click.option("--n_images", type=int, default=30, show_default=True)
+@click.option("--imagesize", type=int, default=288, show_default=True)
+def normalization(n_images, imagesize):
+    """Time of the closed-form segmentation normalization against the per-image loop.
+
+    Their agreement is tested in tests/test_metrics.py.
+    """
+    _, amaps = _synthetic_segmentations(n_images, imagesize)
+    amaps *= np.linspace(0.5, 2, n_images, dtype=np.float32).reshape(-1, 1, 1)
+    flat_amaps = amaps.reshape(n_images, -1)
+    min_scores, max_scores = flat_amaps.min(axis=-1), flat_amaps.max(axis=-1)
+
+    start = time.perf_counter()
+    legacy = metrics.normalize_segmentations_legacy(
+        amaps, min_scores.reshape(-1, 1, 1), max_scores.reshape(-1, 1, 1)
+    )
+    print(f"legacy      time:{time.perf_counter() - start:8.3f}s")
+    for mode in ["mean_affine", "per_image", "global"]:
+        start = time.perf_counter()
+        normalized = metrics.normalize_segmentations(amaps, min_scores, max_scores, mode)
+        print(f"{mode:11s} time:{time.perf_counter() - start:8.3f}s")
+    normalized = metrics.normalize_segmentations(amaps, min_scores, max_scores)
+    max_diff = np.abs(normalized - legacy).max()
+    print(f"mean_affine max abs diff: {max_diff:.3e}")
+
+
+@main.command("smoothing")
+@click.option("--patchsize", type=int, default=36, show_default=True)
+@click.option("--imagesize", type=int, default=288, show_default=True)
+@click.option("--batch_size", type=int, default=8, show_default=True)
+@click.option("--sigma", type=float, default=4, show_default=True)
+@click.option("--repeats", type=int, default=10, show_default=True)
+@click.option("--device", type=str, default="cpu", show_default=True)
+def smoothing(patchsize, imagesize, batch_size, sigma, repeats, device):
+    """Per-batch RescaleSegmentor latency, scipy gaussian_filter against gaussian_blur."""
+    device = torch.device(device)
+    segmentor = common.RescaleSegmentor(device, target_size=(imagesize, imagesize))
+    segmentor.smoothing = sigma
+    patch_scores = torch.randn(batch_size, patchsize, patchsize, device=device)
+
+    def upsample():
+        return torch.nn.functional.interpolate(
+            patch_scores.unsqueeze(1), size=(imagesize, imagesize), mode="bilinear", align_corners=False
+        ).squeeze(1)
+
+    def scipy_path():
+        return [ndimage.gaussian_filter(x, sigma=sigma) for x in upsample().cpu().numpy()]
+
+    def device_path():
+        segmentations, _ = segmentor.convert_to_segmentation(patch_scores)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return segmentations
+
+    max_diff = np.abs(np.stack(scipy_path()) - np.stack(device_path())).max()
+    print(f"batch={batch_size} {patchsize}->{imagesize} sigma={sigma} device={device}")
+    print(f"scipy latency:{_time_call(scipy_path, repeats):9.1f}ms")
+    print(f"torch latency:{_time_call(device_path, repeats):9.1f}ms")
+    print(f"max abs diff: {max_diff:.3e}")
+    if max_diff > 1e-5 * max(1.0, float(patch_scores.abs().max())):
+        raise click.ClickException("gaussian_blur differs from scipy.ndimage.gaussian_filter")
+
+
+@main.command("embed")
+@click.option("--layers_to_extract_from", "-le", type=str, multiple=True, default=["layer2", "layer3"], show_default=True)
+@click.option("--imagesize", type=int, default=288, show_default=True)
+@click.option("--batch_size", type=int, default=8, show_default=True)
+@click.option("--repeats", type=int, default=10, show_default=True)
+@click.option("--device", type=str, default="cpu", show_default=True)
+def embed(layers_to_extract_from, imagesize, batch_size, repeats, device):
+    """Latency, per-stage time and peak memory from backbone features to projected embeddings per embed engine."""
+    layers = list(layers_to_extract_from)
+    engines = ["unfold", "fused", "linear"]
+    print(f"wideresnet50 {layers} patchsize=3 dim=1536 pre_proj=1 batch={batch_size} size={imagesize} device={device}")
+    for engine in engines:
+        latency, memory_before, memory_peak, stage_times = _run_isolated(
+            _embed_worker, engine, layers, imagesize, batch_size, repeats, device
+        )
+        print(
+            f"engine={engine:6s} latency:{latency:9.1f}ms  patches/s:{batch_size * 1000 / latency * (imagesize // 8) ** 2:10.0f}"
+            f"  memory before:{memory_before:8.1f}MB  peak:{memory_peak:8.1f}MB"
+            f"  (+{memory_peak - memory_before:.1f}MB)"
+        )
+        print(f"       stages  {stage_times}")
+
+    device = torch.device(device)
+    images = torch.randn(2, 3, imagesize, imagesize, device=device)
+    embeddings = {}
+    for engine in engines:
+        net = _embedding_net(engine, layers, imagesize, device)
+        with torch.no_grad():
+            embeddings[engine] = net.embedding_engine(images, evaluation=True, project=True)
+    reference, reference_shapes = embeddings["unfold"]
+    for engine in engines[1:]:
+        embedding, patch_shapes = embeddings[engine]
+        max_diff = (embedding - reference).abs().max().item()
+        scale = max(1.0, reference.abs().max().item())
+        print(
+            f"{engine:6s} shapes: {tuple(embedding.shape)} {patch_shapes}"
+            f"  max abs diff: {max_diff:.3e} (relative {max_diff / scale:.1e})"
+        )
+        tolerance = 1e-5 * scale
+        if embedding.shape != reference.shape or patch_shapes != reference_shapes or max_diff > tolerance:
+            raise click.ClickException(f"{engine} embedding differs from the unfold engine")
+
+
+@main.command("noise")
+@click.option("--n_rows", type=int, default=10368, show_default=True)
+@click.option("--dim", type=int, default=1536, show_default=True)
+@click.option("--noise_std", type=float, default=0.015, show_default=True)
+@click.option("--mix_noise", "-k", type=int, multiple=True, default=[1, 2, 4, 8], show_default=True)
+@click.option("--repeats", type=int, default=10, show_default=True)
+@click.option("--device", type=str, default="cpu", show_default=True)
+def noise(n_rows, dim, noise_std, mix_noise, repeats, device):
+    """Synthetic anomaly noise, CPU stack + one-hot mixing against NoiseGenerator."""
+    device = torch.device(device)
+    shape = torch.Size([n_rows, dim])
+    print(f"rows={n_rows} dim={dim} std={noise_std} device={device}")
+    for k in mix_noise:
+        def legacy():
+            noise_idxs = torch.randint(0, k, torch.Size([n_rows]))
+            noise_one_hot = torch.nn.functional.one_hot(noise_idxs, num_classes=k).to(device)
+            noise = torch.stack([
+                torch.normal(0, noise_std * 1.1**(i), shape) for i in range(k)
+            ], dim=1).to(device)
+            noise = (noise * noise_one_hot.unsqueeze(-1)).sum(1)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            return noise
+
+        generator = simplenet.NoiseGenerator(noise_std, k, device, seed=0)
+
+        def on_device():
+            noise = generator(shape)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            return noise
+
+        # Both mix zero-mean normals, so rows have variance mean(std_k**2) on average.
+        expected = np.mean([(noise_std * 1.1**i) ** 2 for i in range(k)])
+        variances = [fn().var(dim=1).mean().item() for fn in (legacy, on_device)]
+        print(
+            f"mix_noise={k}  legacy:{_time_call(legacy, repeats):8.1f}ms"
+            f"  generator:{_time_call(on_device, repeats):8.1f}ms"
+            f"  row variance / expected: {variances[0] / expected:.4f} {variances[1] / expected:.4f}"
+        )
+        if abs(variances[1] / expected - 1) > 0.01:
+            raise click.ClickException("NoiseGenerator has the wrong variance")
+    first, second = (simplenet.NoiseGenerator(noise_std, max(mix_noise), device, seed=0) for _ in range(2))
+    if not torch.equal(first(shape), second(shape)):
+        raise click.ClickException("seeded NoiseGenerators differ")
+    print("seeded generators reproducible: yes")
+
+
+@main.command("logging")
+@click.option("--steps", type=int, default=500, show_default=True)
+@click.option("--log_every", type=int, default=50, show_default=True)
+@click.option("--device", type=str, default="cpu", show_default=True)
+def logging_overhead(steps, log_every, device):
+    """Per-iteration cost of logging discriminator statistics, per-step add_scalar against MetricsBuffer."""
+    device = torch.device(device)
+    scores = torch.randn(10368, 1, device=device)
+
+    def statistics():
+        p_true = (scores >= 0.5).sum() / len(scores)
+        p_fake = (scores < -0.5).sum() / len(scores)
+        return p_true, p_fake, torch.clip(-scores + 0.5, min=0).mean()
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        logger = simplenet.TBWrapper(log_dir)
+
+        def per_step():
+            for _ in range(steps):
+                p_true, p_fake, loss = statistics()
+                for name, value in zip(["p_true", "p_fake", "loss"], [p_true, p_fake, loss]):
+                    logger.add_scalar(name, value)
+                [value.cpu().item() for value in (p_true, p_fake, loss)]
+                logger.step()
+
+        def buffered():
+            buffer = utils.MetricsBuffer(["p_true", "p_fake", "loss"], device, logger, log_every)
+            for _ in range(steps):
+                buffer.log(logger.g_iter, *statistics())
+                logger.step()
+            buffer.means()
+            buffer.close()
+
+        def statistics_only():
+            for _ in range(steps):
+                statistics()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+
+        print(f"steps={steps} log_every={log_every} device={device}")
+        for name, fn in [("no logging", statistics_only), ("per step", per_step), ("buffered", buffered)]:
+            print(f"{name:10s} {_time_call(fn, 1) / steps * 1000:8.1f}us/step")
+        logger.logger.close()
+
+
+def _predict_batches(net, batches, n_images):
+    """Returns the EvaluationAccumulator of net on preloaded batches and the images per second."""
+    evaluation = metrics.EvaluationAccumulator(n_images, net._pixel_accumulator())
+    start = time.perf_counter()
+    for batch in batches:
+        scores, segmentations, _ = net._predict(batch["image"])
+        evaluation.update(
+            scores, segmentations, batch["is_anomaly"].numpy(), batch["mask"].numpy(),
+            batch["image_path"],
+        )
+    return evaluation, n_images / (time.perf_counter() - start)
+
+
+def _trained_net(
+    data_path, subdataset, backbone_name, weight_store, layers_to_extract_from, resize,
+    imagesize, batch_size, meta_epochs, embed_engine, device,
+):
+    """Trains a SimpleNet on an MVTec class.
+
+    Returns the net, the training dataloader, the preloaded test batches and
+    the number of test images.
+    """
+    datasets = {
+        split: mvtec.MVTecDataset(
+            data_path, classname=subdataset, resize=resize, imagesize=imagesize, split=split
+        )
+        for split in [mvtec.DatasetSplit.TRAIN, mvtec.DatasetSplit.TEST]
+    }
+    train_loader = torch.utils.data.DataLoader(
+        datasets[mvtec.DatasetSplit.TRAIN], batch_size=batch_size, shuffle=True
+    )
+    train_loader.name = "mvtec_" + subdataset
+    test_batches = list(torch.utils.data.DataLoader(datasets[mvtec.DatasetSplit.TEST], batch_size=batch_size))
+
+    torch.manual_seed(0)
+    net = simplenet.SimpleNet(device)
+    net.load(
+        backbones.get(backbone_name, weight_store=weight_store), list(layers_to_extract_from),
+        device, (3, imagesize, imagesize), pretrain_embed_dimension=1536,
+        target_embed_dimension=1536, meta_epochs=meta_epochs, gan_epochs=4, noise_std=0.015,
+        dsc_hidden=1024, dsc_margin=0.5, pre_proj=1, embed_engine=embed_engine, tensorboard=False,
+    )
+    with tempfile.TemporaryDirectory() as model_dir:
+        net.set_model_dir(model_dir, subdataset)
+        net.train(train_loader, torch.utils.data.DataLoader(datasets[mvtec.DatasetSplit.TEST], batch_size=batch_size))
+    return net, train_loader, test_batches, len(datasets[mvtec.DatasetSplit.TEST])
+
+
+@main.command("precision")
+@click.argument("data_path", type=click.Path(exists=True, file_okay=False))
+@click.option("--subdataset", "-d", type=str, default="bottle", show_default=True)
+@click.option("--backbone_name", "-b", type=str, default="wideresnet50", show_default=True)
+@click.option("--weight_store", type=click.Path(file_okay=False), default=None)
+@click.option("--layers_to_extract_from", "-le", type=str, multiple=True, default=["layer2", "layer3"], show_default=True)
+@click.option("--resize", type=int, default=329, show_default=True)
+@click.option("--imagesize", type=int, default=288, show_default=True)
+@click.option("--batch_size", type=int, default=8, show_default=True)
+@click.option("--meta_epochs", type=int, default=4, show_default=True)
+@click.option("--embed_engine", type=click.Choice(["unfold", "fused", "linear"]), default="linear", show_default=True)
+@click.option("--compile", "with_compile", is_flag=True, help="Also measure torch.compile modes (slow to warm up).")
+@click.option("--tolerance", type=float, default=0.005, show_default=True, help="Largest accepted I-AUROC/P-AUROC drop.")
+@click.option("--device", type=str, default="cpu", show_default=True)
+def precision(
+    data_path, subdataset, backbone_name, weight_store, layers_to_extract_from, resize,
+    imagesize, batch_size, meta_epochs, embed_engine, with_compile, tolerance, device,
+):
+    """Throughput and I-AUROC/P-AUROC drift of the inference modes of a trained SimpleNet."""
+    device = torch.device(device)
+    modes = [("fp32", False, False), ("fp32", True, False), ("bf16", False, False), ("bf16", True, False)]
+    if device.type == "cuda":
+        modes += [("fp16", False, False), ("fp16", True, False)]
+    if with_compile:
+        modes += [(precision, channels_last, True) for precision, channels_last, _ in modes]
+    net, _, test_batches, n_images = _trained_net(
+        data_path, subdataset, backbone_name, weight_store, layers_to_extract_from, resize,
+        imagesize, batch_size, meta_epochs, embed_engine, device,
+    )
+
+    print(f"{backbone_name} {list(layers_to_extract_from)} {subdataset} {n_images} test images size={imagesize} engine={embed_engine} device={device}")
+    results = []
+    for mode in modes:
+        net.set_inference_mode(*mode)
+        net._predict(test_batches[0]["image"])  # warm up, compiles with compile_backbone
+        evaluation, throughput = _predict_batches(net, test_batches, n_images)
+        auroc, pixel_auroc, _ = net._evaluate(evaluation)
+        results.append((mode, throughput, auroc, pixel_auroc))
+    _, _, reference_auroc, reference_pixel_auroc = results[0]
+    best = None
+    for mode, throughput, auroc, pixel_auroc in results:
+        drift = max(reference_auroc - auroc, reference_pixel_auroc - pixel_auroc)
+        name = "{} channels_last={} compile={}".format(*mode)
+        print(
+            f"{name:40s} {throughput:8.1f} img/s  I-AUROC:{auroc:.4f} ({auroc - reference_auroc:+.4f})"
+            f"  P-AUROC:{pixel_auroc:.4f} ({pixel_auroc - reference_pixel_auroc:+.4f})"
+        )
+        if drift <= tolerance and (best is None or throughput > best[1]):
+            best = (name, throughput)
+    print(f"fastest within tolerance {tolerance}: {best[0]}")
+
+
+@main.command("quantization")
+@click.argument("data_path", type=click.Path(exists=True, file_okay=False))
+@click.option("--subdataset", "-d", type=str, default="bottle", show_default=True)
+@click.option("--backbone_name", "-b", type=str, default="wideresnet50", show_default=True)
+@click.option("--weight_store", type=click.Path(file_okay=False), default=None)
+@click.option("--layers_to_extract_from", "-le", type=str, multiple=True, default=["layer2", "layer3"], show_default=True)
+@click.option("--resize", type=int, default=329, show_default=True)
+@click.option("--imagesize", type=int, default=288, show_default=True)
+@click.option("--batch_size", type=int, default=8, show_default=True)
+@click.option("--meta_epochs", type=int, default=4, show_default=True)
+@click.option("--embed_engine", type=click.Choice(["unfold", "fused", "linear"]), default="linear", show_default=True)
+@click.option("--calibration_batches", type=int, default=8, show_default=True)
+@click.option("--threads", type=int, default=0, help="torch threads, 0 keeps the default.")
+def quantization(
+    data_path, subdataset, backbone_name, weight_store, layers_to_extract_from, resize,
+    imagesize, batch_size, meta_epochs, embed_engine, calibration_batches, threads,
+):
+    """Throughput and I-AUROC/P-AUROC of int8 against float inference of a trained SimpleNet on the CPU."""
+    if threads:
+        torch.set_num_threads(threads)
+    device = torch.device("cpu")
+    net, train_loader, test_batches, n_images = _trained_net(
+        data_path, subdataset, backbone_name, weight_store, layers_to_extract_from, resize,
+        imagesize, batch_size, meta_epochs, embed_engine, device,
+    )
+
+    print(
+        f"{backbone_name} {list(layers_to_extract_from)} {subdataset} {n_images} test images size={imagesize}"
+        f" engine={embed_engine} threads={torch.get_num_threads()} backend={torch.backends.quantized.engine}"
+    )
+    net._predict(test_batches[0]["image"])
+    evaluation, float_throughput = _predict_batches(net, test_batches, n_images)
+    float_auroc, float_pixel_auroc, _ = net._evaluate(evaluation)
+    print(f"{'fp32':6s} {float_throughput:8.1f} img/s  I-AUROC:{float_auroc:.4f}  P-AUROC:{float_pixel_auroc:.4f}")
+
+    start = time.perf_counter()
+    net.quantize(train_loader, calibration_batches)
+    print(f"calibration on {calibration_batches} batches: {time.perf_counter() - start:.1f}s")
+    net._predict(test_batches[0]["image"])
+    evaluation, throughput = _predict_batches(net, test_batches, n_images)
+    auroc, pixel_auroc, _ = net._evaluate(evaluation)
+    print(
+        f"{'int8':6s} {throughput:8.1f} img/s  I-AUROC:{auroc:.4f} ({auroc - float_auroc:+.4f})"
+        f"  P-AUROC:{pixel_auroc:.4f} ({pixel_auroc - float_pixel_auroc:+.4f})  x{throughput / float_throughput:.2f}"
+    )
+
+    scores = net._predict(test_batches[0]["image"], return_segmentations=False)[0]
+    with tempfile.TemporaryDirectory() as export_dir:
+        path = os.path.join(export_dir, "ckpt_int8.pth")
+        net.export_quantized(path)
+        size = os.path.getsize(path) / 2**20
+        net.load_quantized(path)
+    reloaded = net._predict(test_batches[0]["image"], return_segmentations=False)[0]
+    print(f"exported {size:.1f}MB, reloaded scores identical: {'yes' if np.array_equal(scores, reloaded) else 'no'}")
+    if not np.array_equal(scores, reloaded):
+        raise click.ClickException("int8 scores changed after export_quantized/load_quantized")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    LOGGER.info("Command line arguments: {}".format(" ".join(sys.argv)))
+    main()
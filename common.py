@@ -1,11 +1,21 @@
+import contextlib
 import copy
+import hashlib
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+import warnings
 from typing import List
 
 import numpy as np
-import scipy.ndimage as ndimage
 import torch
 import torch.nn.functional as F
 
+LOGGER = logging.getLogger(__name__)
+
 
 class _BaseMerger:
     def __init__(self):
@@ -73,58 +83,622 @@ class Aggregator(torch.nn.Module):
         return features.reshape(len(features), -1)
 
 
+class UnfoldPatchStages:
+    """patchify, align and pool stages that unfold every patch.
+
+    Patches of all layers are aligned to the patch grid of the first layer,
+    then pooled with Preprocessing and the preadapt Aggregator. With
+    per_image the patches of an image are pooled into one embedding.
+    """
+
+    def __init__(self, patch_maker, preprocessing, aggregator, per_image=False):
+        self.patch_maker = patch_maker
+        self.preprocessing = preprocessing
+        self.aggregator = aggregator
+        self.per_image = per_image
+
+    def patchify(self, features):
+        features = [
+            self.patch_maker.patchify(x, return_spatial_info=True) for x in features
+        ]
+        return [x[0] for x in features], [x[1] for x in features]
+
+    def align(self, features, patch_shapes):
+        ref_num_patches = patch_shapes[0]
+        for i in range(1, len(features)):
+            _features = features[i]
+            patch_dims = patch_shapes[i]
+
+            # batchsize x patch rows x patch columns x channels x patchsize x
+            # patchsize, interpolated over the patch grid for every entry.
+            _features = _features.reshape(
+                _features.shape[0], patch_dims[0], patch_dims[1], *_features.shape[2:]
+            )
+            _features = _features.permute(0, -3, -2, -1, 1, 2)
+            perm_base_shape = _features.shape
+            _features = _features.reshape(-1, *_features.shape[-2:])
+            _features = F.interpolate(
+                _features.unsqueeze(1),
+                size=(ref_num_patches[0], ref_num_patches[1]),
+                mode="bilinear",
+                align_corners=False,
+            )
+            _features = _features.squeeze(1)
+            _features = _features.reshape(
+                *perm_base_shape[:-2], ref_num_patches[0], ref_num_patches[1]
+            )
+            _features = _features.permute(0, -2, -1, 1, 2, 3)
+            _features = _features.reshape(len(_features), -1, *_features.shape[-3:])
+            features[i] = _features
+        return features
+
+    def pool(self, features):
+        if self.per_image:
+            features = [x.reshape(x.shape[0], -1) for x in features]
+        else:
+            features = [x.reshape(-1, *x.shape[-3:]) for x in features]
+        # As different feature backbones & patching provide differently
+        # sized features, these are brought into the correct form here.
+        features = self.preprocessing(features)
+        return self.aggregator(features)
+
+
+class PatchPooling(torch.nn.Module):
+    """patchify, align and pool stages without unfolding.
+
+    MeanMapper averages runs of consecutive entries of a flattened
+    (channel, patch row, patch column) patch. When the patch length is a
+    multiple of output_dim, every run covers whole neighbourhoods of a few
+    channels, so the pooling is a grouped convolution with constant weights
+    over the feature map and the 9x larger unfolded tensor is never built.
+    Deeper layers are pooled before they are upsampled to the patch grid of
+    the first layer: pooling mixes channels and interpolation mixes
+    locations, so the order does not change the result.
+    """
+
+    def __init__(self, input_dims, output_dim, aggregator, patchsize=3, patchstride=1):
+        super(PatchPooling, self).__init__()
+        self.output_dim = output_dim
+        self.aggregator = aggregator
+        self.patchsize = patchsize
+        self.patchstride = patchstride
+        self.padding = int((patchsize - 1) / 2)
+        self.groups = []
+        for i, input_dim in enumerate(input_dims):
+            weight, groups = self._pooling_weight(input_dim)
+            self.groups.append(groups)
+            self.register_buffer("weight_{}".format(i), weight, persistent=False)
+
+    def _pooling_weight(self, input_dim):
+        """Returns the grouped convolution of MeanMapper, or (None, 0) if there is none."""
+        patch_length = self.patchsize ** 2
+        length = input_dim * patch_length
+        if length % self.output_dim:
+            return None, 0
+        run = length // self.output_dim
+        # Smallest block of whole channels that holds whole runs.
+        block = run * patch_length // math.gcd(run, patch_length)
+        in_channels, out_channels = block // patch_length, block // run
+        if input_dim % in_channels:
+            return None, 0
+        pattern = torch.zeros(out_channels, block)
+        for out_channel in range(out_channels):
+            pattern[out_channel, out_channel * run:(out_channel + 1) * run] = 1 / run
+        pattern = pattern.reshape(out_channels, in_channels, self.patchsize, self.patchsize)
+        groups = input_dim // in_channels
+        return pattern.repeat(groups, 1, 1, 1), groups
+
+    def _pool(self, features, i):
+        weight = getattr(self, "weight_{}".format(i))
+        if weight is not None:
+            return F.conv2d(
+                features, weight.to(features.dtype), stride=self.patchstride,
+                padding=self.padding, groups=self.groups[i],
+            )
+        # Uneven MeanMapper runs, pool the unfolded patches.
+        batchsize, _, height, width = features.shape
+        patches = F.unfold(
+            features, self.patchsize, padding=self.padding, stride=self.patchstride
+        )
+        n_patches = patches.shape[-1]
+        patches = patches.transpose(1, 2).reshape(batchsize * n_patches, 1, -1)
+        pooled = F.adaptive_avg_pool1d(patches, self.output_dim)
+        pooled = pooled.reshape(batchsize, n_patches, -1).transpose(1, 2)
+        n_rows = (height + 2 * self.padding - self.patchsize) // self.patchstride + 1
+        return pooled.reshape(batchsize, self.output_dim, n_rows, -1)
+
+    def patchify(self, features):
+        features = [self._pool(feature, i) for i, feature in enumerate(features)]
+        return features, [list(feature.shape[-2:]) for feature in features]
+
+    def align(self, features, patch_shapes):
+        for i in range(1, len(features)):
+            features[i] = F.interpolate(
+                features[i], size=patch_shapes[0], mode="bilinear", align_corners=False
+            )
+        return features
+
+    def pool(self, features):
+        features = torch.stack(features, dim=1)
+        features = features.permute(0, 3, 4, 1, 2)
+        return self.aggregator(features.reshape(-1, *features.shape[-2:]))
+
+    def forward(self, features):
+        features, patch_shapes = self.patchify(features)
+        return self.pool(self.align(features, patch_shapes)), patch_shapes
+
+
+def linear_map(fn, input_dims, chunk_size=1024):
+    """Returns the matrices of a linear fn of per-layer patch vectors.
+
+    fn maps a list of n x input_dim tensors, one per layer, to n x output_dim.
+    The i-th matrix is output_dim x input_dims[i], fn(x) = sum_i m_i x_i.
+    """
+    maps = []
+    for i, input_dim in enumerate(input_dims):
+        columns = []
+        for start in range(0, input_dim, chunk_size):
+            rows = torch.arange(start, min(start + chunk_size, input_dim))
+            basis = torch.zeros(len(rows), input_dim)
+            basis[torch.arange(len(rows)), rows] = 1
+            inputs = [
+                basis if j == i else torch.zeros(len(basis), dim)
+                for j, dim in enumerate(input_dims)
+            ]
+            with torch.no_grad():
+                columns.append(fn(inputs))
+        maps.append(torch.cat(columns).T.contiguous())
+    return maps
+
+
+def grouped_conv_weight(matrix, input_dim, patchsize):
+    """Writes a patch map as the weight of the sparsest equivalent grouped convolution.
+
+    matrix is n_outputs x (input_dim * patchsize**2) and acts on flattened
+    (channel, patch row, patch column) patches. Returns (weight, groups,
+    outputs), where output j of the convolution is row outputs[j] of matrix.
+    Rows without any non-zero entry are left out.
+    """
+    patch_length = patchsize ** 2
+    nonzero = matrix != 0
+    outputs = torch.nonzero(nonzero.any(dim=1)).flatten()
+    matrix, nonzero = matrix[outputs], nonzero[outputs]
+    first = nonzero.float().argmax(dim=1)
+    last = matrix.shape[1] - 1 - nonzero.flip(1).float().argmax(dim=1)
+    order = torch.sort(first, stable=True).indices
+    matrix, first, last, outputs = matrix[order], first[order], last[order], outputs[order]
+    n_outputs = len(outputs)
+    for in_channels in range(1, input_dim + 1):
+        groups = input_dim // in_channels
+        if input_dim % in_channels or n_outputs % groups:
+            continue
+        block = in_channels * patch_length
+        group = first // block
+        expected = torch.arange(n_outputs) // (n_outputs // groups)
+        if torch.equal(group, last // block) and torch.equal(group, expected):
+            weight = matrix.reshape(n_outputs, groups, block)[torch.arange(n_outputs), group]
+            return weight.reshape(n_outputs, in_channels, patchsize, patchsize), groups, outputs
+
+
+class LinearPatchEmbedding(torch.nn.Module):
+    """patchify, align and pool stages as one precomputed linear map.
+
+    layer_maps[i] maps the flattened patches of layer i to the embedding,
+    see linear_map. Each is applied as a grouped convolution on the feature
+    map of its layer. A linear projection, a (weight, bias) pair passed to
+    patchify and pool, is applied as a 1x1 convolution on every layer before
+    the layers are upsampled to the patch grid of the first layer, so deeper
+    layers are projected at their lower resolution.
+    """
+
+    folds_projection = True
+
+    def __init__(self, layer_maps, input_dims, patchsize=3, patchstride=1):
+        super(LinearPatchEmbedding, self).__init__()
+        self.output_dim = layer_maps[0].shape[0]
+        self.patchstride = patchstride
+        self.padding = int((patchsize - 1) / 2)
+        self.groups = []
+        for i, (layer_map, input_dim) in enumerate(zip(layer_maps, input_dims)):
+            weight, groups, outputs = grouped_conv_weight(layer_map, input_dim, patchsize)
+            self.groups.append(groups)
+            self.register_buffer("weight_{}".format(i), weight, persistent=False)
+            self.register_buffer("outputs_{}".format(i), outputs, persistent=False)
+
+    def patchify(self, features, projection=None):
+        patches, patch_shapes = [], []
+        for i, feature in enumerate(features):
+            feature = F.conv2d(
+                feature, getattr(self, "weight_{}".format(i)), stride=self.patchstride,
+                padding=self.padding, groups=self.groups[i],
+            )
+            patch_shapes.append(list(feature.shape[-2:]))
+            if projection is not None:
+                outputs = getattr(self, "outputs_{}".format(i))
+                feature = F.conv2d(feature, projection[0][:, outputs, None, None])
+            patches.append(feature)
+        return patches, patch_shapes
+
+    def align(self, features, patch_shapes):
+        for i in range(1, len(features)):
+            features[i] = F.interpolate(
+                features[i], size=patch_shapes[0], mode="bilinear", align_corners=False
+            )
+        return features
+
+    def pool(self, features, projection=None):
+        if projection is not None:
+            embedding = sum(features[1:], features[0])
+            embedding = embedding + projection[1].reshape(1, -1, 1, 1)
+        else:
+            embedding = features[0].new_zeros(
+                len(features[0]), self.output_dim, *features[0].shape[-2:]
+            )
+            for i, feature in enumerate(features):
+                embedding.index_add_(1, getattr(self, "outputs_{}".format(i)), feature)
+        embedding = embedding.permute(0, 2, 3, 1)
+        return embedding.reshape(-1, embedding.shape[-1])
+
+    def forward(self, features, projection=None):
+        features, patch_shapes = self.patchify(features, projection)
+        return self.pool(self.align(features, patch_shapes), projection), patch_shapes
+
+
+class EmbeddingEngine:
+    """Turns images into patch embeddings in the stages extract, patchify,
+    align, pool and project.
+
+    extract runs the backbone, patchify/align/pool are taken from stages
+    (UnfoldPatchStages, PatchPooling or LinearPatchEmbedding) and project
+    applies the optional projection module. Hooks registered with
+    add_timing_hook are called with (stage, seconds) after every stage.
+    """
+
+    STAGES = ("extract", "patchify", "align", "pool", "project")
+    AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+    def __init__(
+        self, feature_aggregator, layers_to_extract_from, stages,
+        projection=None, train_backbone=False,
+    ):
+        self.feature_aggregator = feature_aggregator
+        self.layers_to_extract_from = layers_to_extract_from
+        self.stages = stages
+        self.projection = projection
+        self.train_backbone = train_backbone
+        self.timing_hooks = []
+        # Autocast dtype of evaluation passes, "fp32", "bf16" or "fp16".
+        self.precision = "fp32"
+
+    def add_timing_hook(self, hook):
+        self.timing_hooks.append(hook)
+        return hook
+
+    def remove_timing_hook(self, hook):
+        self.timing_hooks.remove(hook)
+
+    def _run(self, stage, fn, *args, **kwargs):
+        if not self.timing_hooks:
+            return fn(*args, **kwargs)
+        device = self.feature_aggregator.device
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start
+        for hook in self.timing_hooks:
+            hook(stage, elapsed)
+        return result
+
+    def extract(self, images, evaluation=False):
+        """Returns the backbone feature maps of images, one per layer."""
+        if not evaluation and self.train_backbone:
+            self.feature_aggregator.train()
+            features = self.feature_aggregator(images, eval=evaluation)
+        else:
+            _ = self.feature_aggregator.eval()
+            with torch.no_grad():
+                features = self.feature_aggregator(images)
+
+        features = [features[layer] for layer in self.layers_to_extract_from]
+        for i, feat in enumerate(features):
+            if len(feat.shape) == 3:
+                # Tokens of a vision transformer, batchsize x tokens x channels.
+                B, L, C = feat.shape
+                features[i] = feat.reshape(B, int(math.sqrt(L)), int(math.sqrt(L)), C).permute(0, 3, 1, 2)
+        return features
+
+    def linear_projection(self):
+        """Returns projection, a stack of Linear layers, as one (weight, bias) pair.
+
+        Returns None if the stack holds any other layer.
+        """
+        weight, bias = None, None
+        for layer in self.projection.modules():
+            if isinstance(layer, torch.nn.Linear):
+                if weight is None:
+                    weight, bias = layer.weight, layer.bias
+                else:
+                    weight, bias = layer.weight @ weight, layer.weight @ bias + layer.bias
+            elif not list(layer.children()):
+                return None
+        if weight is None:
+            return None
+        return weight.detach(), bias.detach()
+
+    def embed_features(self, features, project=False):
+        """Returns the embeddings and patch shapes of per-layer feature maps."""
+        project = project and self.projection is not None
+        folded = {}
+        if project and getattr(self.stages, "folds_projection", False):
+            projection = self.linear_projection()
+            if projection is not None:
+                folded = {"projection": projection}
+        features, patch_shapes = self._run("patchify", self.stages.patchify, features, **folded)
+        features = self._run("align", self.stages.align, features, patch_shapes)
+        features = self._run("pool", self.stages.pool, features, **folded)
+        if project and not folded:
+            features = self._run("project", self.projection, features)
+        return features, patch_shapes
+
+    def __call__(self, images, evaluation=False, project=False):
+        """Returns the embeddings and patch shapes of images.
+
+        The backbone runs in training mode unless evaluation is set or it is
+        frozen, project passes the embeddings through projection. With
+        evaluation, all stages run under autocast to precision and the
+        embeddings are returned in float32.
+        """
+        if not evaluation or self.precision == "fp32":
+            features = self._run("extract", self.extract, images, evaluation)
+            return self.embed_features(features, project)
+        device_type = self.feature_aggregator.device.type
+        with torch.autocast(device_type, dtype=self.AUTOCAST_DTYPES[self.precision]):
+            features = self._run("extract", self.extract, images, evaluation)
+            features, patch_shapes = self.embed_features(features, project)
+        return features.float(), patch_shapes
+
+
+class StageTimes:
+    """Timing hook of EmbeddingEngine that sums the time spent per stage."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def __call__(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def summary(self):
+        return "  ".join(
+            "{}:{:.1f}ms".format(stage, 1000 * self.seconds[stage] / self.calls[stage])
+            for stage in EmbeddingEngine.STAGES if stage in self.seconds
+        )
+
+
+class FeatureCache:
+    """Per-image store for embeddings of a frozen backbone.
+
+    Entries live in memory until max_memory bytes are used. Further entries
+    are spilled to memory-mapped .npy files in a private subdirectory of
+    spill_dir, so caches sharing spill_dir never see each other's files, or
+    not stored at all if no spill_dir is given. clear removes the
+    subdirectory.
+    """
+
+    def __init__(self, max_memory=2**30, spill_dir=None):
+        self.max_memory = max_memory
+        self.spill_dir = None
+        self._memory = {}
+        self._spilled = {}
+        self._memory_used = 0
+        self._budget_logged = False
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix="feature_cache_", dir=spill_dir)
+
+    @staticmethod
+    def key(image_path, transform_key):
+        return "{}|{}".format(image_path, transform_key)
+
+    def __contains__(self, key):
+        return key in self._memory or key in self._spilled
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    def get(self, key):
+        if key in self._memory:
+            return self._memory[key]
+        return torch.from_numpy(np.array(np.load(self._spilled[key], mmap_mode="r")))
+
+    def put(self, key, features):
+        if key in self:
+            return
+        features = features.detach().cpu().clone()
+        n_bytes = features.numel() * features.element_size()
+        if self._memory_used + n_bytes <= self.max_memory:
+            self._memory[key] = features
+            self._memory_used += n_bytes
+        elif self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            filename = hashlib.sha1(key.encode()).hexdigest() + ".npy"
+            path = os.path.join(self.spill_dir, filename)
+            spill = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.float32, shape=tuple(features.shape)
+            )
+            spill[:] = features.to(torch.float32).numpy()
+            spill.flush()
+            self._spilled[key] = path
+        elif not self._budget_logged:
+            self._budget_logged = True
+            LOGGER.warning(
+                "Feature cache is full ({} entries, {:.1f} MB), further embeddings are "
+                "recomputed every epoch. Raise its memory or give it a spill directory.".format(
+                    len(self._memory), self._memory_used / 2**20
+                )
+            )
+
+    def clear(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self._memory.clear()
+        self._spilled.clear()
+        self._memory_used = 0
+        self._budget_logged = False
+
+
+_GAUSSIAN_OPERATORS = {}
+
+
+def _gaussian_operator(size, sigma, truncate, dtype, device):
+    """Returns the [size x size] matrix of a 1D Gaussian filter.
+
+    Uses the weights, support and default "reflect" boundary handling
+    (d c b a | a b c d) of scipy.ndimage.gaussian_filter. Taps that fall
+    outside of the signal are folded back onto the pixel they mirror.
+    """
+    key = (size, sigma, truncate, dtype, str(device))
+    if key not in _GAUSSIAN_OPERATORS:
+        radius = int(truncate * sigma + 0.5)
+        offsets = torch.arange(-radius, radius + 1, dtype=torch.float64)
+        kernel = torch.exp(-0.5 * (offsets / sigma) ** 2)
+        kernel = kernel / kernel.sum()
+
+        positions = torch.arange(size).reshape(-1, 1) + torch.arange(-radius, radius + 1)
+        # Folding with period 2 * size also holds when radius exceeds size.
+        positions = positions % (2 * size)
+        positions = torch.where(positions < size, positions, 2 * size - 1 - positions)
+        operator = torch.zeros(size, size, dtype=torch.float64)
+        operator.scatter_add_(1, positions, kernel.expand(size, -1).contiguous())
+        _GAUSSIAN_OPERATORS[key] = operator.to(dtype=dtype, device=device)
+    return _GAUSSIAN_OPERATORS[key]
+
+
+def gaussian_blur(images, sigma, truncate=4.0):
+    """Separable Gaussian blur of [N x H x W] images on their device.
+
+    Matches scipy.ndimage.gaussian_filter(image, sigma) per image. Both 1D
+    passes are expressed as matrix products with banded filter matrices,
+    which batches well on CPU and GPU alike.
+    """
+    height, width = images.shape[-2:]
+    rows = _gaussian_operator(height, sigma, truncate, images.dtype, images.device)
+    columns = _gaussian_operator(width, sigma, truncate, images.dtype, images.device)
+    return rows @ images @ columns.T
+
+
+_BLURRED_RESIZE_OPERATORS = {}
+
+
+def _bilinear_operator(in_size, out_size):
+    """Returns the [out_size x in_size] matrix of a 1D bilinear resize.
+
+    Follows F.interpolate(mode="bilinear", align_corners=False): sample
+    positions (i + 0.5) * in_size / out_size - 0.5 are clamped at zero and
+    interpolate between their two neighbouring input pixels.
+    """
+    positions = (torch.arange(out_size, dtype=torch.float64) + 0.5) * (in_size / out_size) - 0.5
+    positions = positions.clamp(min=0)
+    lower = positions.floor().long().clamp(max=in_size - 1)
+    upper = (lower + 1).clamp(max=in_size - 1)
+    weight = positions - lower
+    operator = torch.zeros(out_size, in_size, dtype=torch.float64)
+    rows = torch.arange(out_size)
+    operator.index_put_((rows, lower), 1 - weight, accumulate=True)
+    operator.index_put_((rows, upper), weight, accumulate=True)
+    return operator
+
+
+def _blurred_resize_operator(in_size, out_size, sigma, truncate, dtype, device):
+    """Returns the [out_size x in_size] product of a Gaussian filter and a bilinear resize."""
+    key = (in_size, out_size, sigma, truncate, dtype, str(device))
+    if key not in _BLURRED_RESIZE_OPERATORS:
+        blur = _gaussian_operator(out_size, sigma, truncate, torch.float64, "cpu")
+        operator = blur @ _bilinear_operator(in_size, out_size)
+        _BLURRED_RESIZE_OPERATORS[key] = operator.to(dtype=dtype, device=device)
+    return _BLURRED_RESIZE_OPERATORS[key]
+
+
+def resize_and_blur(images, size, sigma, truncate=4.0):
+    """Bilinearly resizes [N x h x w] images to size and blurs them.
+
+    Equals F.interpolate(mode="bilinear", align_corners=False) followed by
+    gaussian_blur, but both steps are folded into one cached [H x h] and
+    [W x w] operator pair, so the full-size image is only formed once.
+    """
+    height, width = (size, size) if isinstance(size, int) else size
+    rows = _blurred_resize_operator(
+        images.shape[-2], height, sigma, truncate, images.dtype, images.device
+    )
+    columns = _blurred_resize_operator(
+        images.shape[-1], width, sigma, truncate, images.dtype, images.device
+    )
+    return rows @ images @ columns.T
+
+
 class RescaleSegmentor:
     def __init__(self, device, target_size=224):
         self.device = device
         self.target_size = target_size
         self.smoothing = 4
 
-    def convert_to_segmentation(self, patch_scores, features):
+    def convert_to_segmentation(self, patch_scores, features=None):
+        """Upsamples and smooths patch scores to anomaly segmentations.
+
+        Features are only upsampled to target_size as well if given, as
+        that is the expensive part; otherwise an empty list is returned
+        in their place.
+        """
 
         with torch.no_grad():
             if isinstance(patch_scores, np.ndarray):
                 patch_scores = torch.from_numpy(patch_scores)
             _scores = patch_scores.to(self.device)
-            _scores = _scores.unsqueeze(1)
-            _scores = F.interpolate(
-                _scores, size=self.target_size, mode="bilinear", align_corners=False
-            )
-            _scores = _scores.squeeze(1)
-            patch_scores = _scores.cpu().numpy()
+            _scores = resize_and_blur(_scores, self.target_size, sigma=self.smoothing)
+            segmentations = list(_scores.cpu().numpy())
+
+        if features is None:
+            return segmentations, []
+        return segmentations, self.upsample_features(features)
 
+    def upsample_features(self, features):
+        """Bilinearly upsamples [N x H x W x C] features to [N x C x target_size]."""
+        with torch.no_grad():
             if isinstance(features, np.ndarray):
                 features = torch.from_numpy(features)
-            features = features.to(self.device).permute(0, 3, 1, 2)
-            if self.target_size[0] * self.target_size[1] * features.shape[0] * features.shape[1] >= 2**31:
-                subbatch_size = int((2**31-1) / (self.target_size[0] * self.target_size[1] * features.shape[1]))
-                interpolated_features = []
-                for i_subbatch in range(int(features.shape[0] / subbatch_size + 1)):
-                    subfeatures = features[i_subbatch*subbatch_size:(i_subbatch+1)*subbatch_size]
-                    subfeatures = subfeatures.unsuqeeze(0) if len(subfeatures.shape) == 3 else subfeatures
-                    subfeatures = F.interpolate(
-                        subfeatures, size=self.target_size, mode="bilinear", align_corners=False
-                    )
-                    interpolated_features.append(subfeatures)
-                features = torch.cat(interpolated_features, 0)
-            else:
-                features = F.interpolate(
-                    features, size=self.target_size, mode="bilinear", align_corners=False
+            features = features.to(self.device)
+            features = features.unsqueeze(0) if len(features.shape) == 3 else features
+            features = features.permute(0, 3, 1, 2)
+            # F.interpolate indexes with int32, so keep every call below 2**31 elements.
+            elements_per_image = self.target_size[0] * self.target_size[1] * features.shape[1]
+            subbatch_size = max(1, (2**31 - 1) // elements_per_image)
+            interpolated_features = []
+            for i in range(0, features.shape[0], subbatch_size):
+                subfeatures = F.interpolate(
+                    features[i:i + subbatch_size],
+                    size=self.target_size,
+                    mode="bilinear",
+                    align_corners=False,
                 )
-            features = features.cpu().numpy()
-
+                interpolated_features.append(subfeatures.cpu().numpy())
         return [
-            ndimage.gaussian_filter(patch_score, sigma=self.smoothing)
-            for patch_score in patch_scores
-        ], [ 
             feature
-            for feature in features
+            for subfeatures in interpolated_features
+            for feature in subfeatures
         ]
 
 
+_TRUNCATION_MODES = ("exit", "prune", "none")
+
+
 class NetworkFeatureAggregator(torch.nn.Module):
     """Efficient extraction of network features."""
 
-    def __init__(self, backbone, layers_to_extract_from, device, train_backbone=False):
+    def __init__(self, backbone, layers_to_extract_from, device, train_backbone=False, truncate="exit"):
         super(NetworkFeatureAggregator, self).__init__()
         """Extraction of network features.
 
@@ -134,75 +708,175 @@ class NetworkFeatureAggregator(torch.nn.Module):
         Args:
             backbone: torchvision.model
             layers_to_extract_from: [list of str]
+            truncate: [str] How the backbone is cut after the last layer in
+                      layers_to_extract_from. "exit" stops the forward pass
+                      once that layer has produced its output, "prune"
+                      additionally runs a view of the backbone in which all
+                      modules registered after it are identities, so that
+                      their weights are released once the caller drops the
+                      backbone, "none" runs the full backbone.
         """
+        if truncate not in _TRUNCATION_MODES:
+            raise ValueError(
+                "truncate should be one of {}, got {}".format(_TRUNCATION_MODES, truncate)
+            )
         self.layers_to_extract_from = layers_to_extract_from
+        # The backbone may be shared by several aggregators. Only one set
+        # of hooks is registered at a time, owned by the aggregator whose
+        # token is stored in the hook state of the backbone. Pruned views
+        # share that state, as they share the hooked modules.
+        if not hasattr(backbone, "hook_state"):
+            backbone.hook_state = {"handles": [], "owner": None}
+        if truncate == "prune":
+            backbone = _pruned_view(backbone, layers_to_extract_from[-1])
         self.backbone = backbone
         self.device = device
         self.train_backbone = train_backbone
-        if not hasattr(backbone, "hook_handles"):
-            self.backbone.hook_handles = []
-        for handle in self.backbone.hook_handles:
-            handle.remove()
+        self.truncate = truncate
         self.outputs = {}
+        self.channels_last = False
+        self.compiled_forward = None
+        self.quantized_backbone = None
+        self._hook_token = object()
+        self._register_hooks()
+        self.to(self.device)
+
+    def _register_hooks(self):
+        hook_state = self.backbone.hook_state
+        for handle in hook_state["handles"]:
+            handle.remove()
+        hook_state["handles"] = []
 
-        for extract_layer in layers_to_extract_from:
+        for extract_layer in self.layers_to_extract_from:
             forward_hook = ForwardHook(
-                self.outputs, extract_layer, layers_to_extract_from[-1]
+                self.outputs,
+                extract_layer,
+                self.layers_to_extract_from[-1],
+                early_exit=self.truncate != "none",
             )
             if "." in extract_layer:
                 extract_block, extract_idx = extract_layer.split(".")
-                network_layer = backbone.__dict__["_modules"][extract_block]
+                network_layer = self.backbone.__dict__["_modules"][extract_block]
                 if extract_idx.isnumeric():
                     extract_idx = int(extract_idx)
                     network_layer = network_layer[extract_idx]
                 else:
                     network_layer = network_layer.__dict__["_modules"][extract_idx]
             else:
-                network_layer = backbone.__dict__["_modules"][extract_layer]
+                network_layer = self.backbone.__dict__["_modules"][extract_layer]
 
             if isinstance(network_layer, torch.nn.Sequential):
-                self.backbone.hook_handles.append(
+                hook_state["handles"].append(
                     network_layer[-1].register_forward_hook(forward_hook)
                 )
             else:
-                self.backbone.hook_handles.append(
+                hook_state["handles"].append(
                     network_layer.register_forward_hook(forward_hook)
                 )
-        self.to(self.device)
+        hook_state["owner"] = self._hook_token
+
+    def set_inference_mode(self, channels_last=False, compile=False):
+        """Runs the frozen backbone on channels_last inputs and/or through torch.compile.
+
+        Only no-grad forward passes are affected, a backbone that is being
+        trained always runs eagerly. The backbone itself is left unchanged,
+        as it may be shared: convolutions follow the memory format of their
+        input.
+        """
+        self.channels_last = channels_last
+        # A compiled bound method, not a module, so that the state_dict is unchanged.
+        self.compiled_forward = torch.compile(self.backbone.forward) if compile else None
+
+    def quantize(self, example_images, calibration_batches=(), backend=None):
+        """Runs no-grad passes through a static int8 copy of the truncated backbone.
+
+        See quantize_static, example_images is a batch of the input shape.
+        """
+        self.quantized_backbone = quantize_static(
+            TruncatedBackbone(self.backbone, self.layers_to_extract_from),
+            example_images, calibration_batches, backend,
+        )
 
     def forward(self, images, eval=True):
+        if self.backbone.hook_state["owner"] is not self._hook_token:
+            self._register_hooks()
         self.outputs.clear()
+        # The backbone will throw an Exception once it reached the last
+        # layer to compute features from. Computation will stop there.
         if self.train_backbone and not eval:
-            self.backbone(images) ##여기서 피처값 뽑힘
+            try:
+                self.backbone(images) ##여기서 피처값 뽑힘
+            except LastLayerToExtractReachedException:
+                pass
         else:
+            if self.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
+            backbone = self.compiled_forward or self.backbone
             with torch.no_grad():
-                # The backbone will throw an Exception once it reached the last
-                # layer to compute features from. Computation will stop there.
-                try:
-                    _ = self.backbone(images)
-                except LastLayerToExtractReachedException:
-                    pass
+                if self.quantized_backbone is not None:
+                    self.outputs.update(self.quantized_backbone(images))
+                else:
+                    try:
+                        _ = backbone(images)
+                    except LastLayerToExtractReachedException:
+                        pass
         return self.outputs
 
     def feature_dimensions(self, input_shape):
-        """Computes the feature dimensions for all layers given input_shape."""
-        _input = torch.ones([1] + list(input_shape)).to(self.device)
-        _output = self(_input)
-        return [_output[layer].shape[1] for layer in self.layers_to_extract_from]
+        """Computes the feature dimensions for all layers given input_shape.
+
+        The result is memoized on the backbone, as probing runs a forward pass.
+        """
+        if not hasattr(self.backbone, "feature_dimensions_memo"):
+            self.backbone.feature_dimensions_memo = {}
+        key = (tuple(self.layers_to_extract_from), tuple(input_shape))
+        if key not in self.backbone.feature_dimensions_memo:
+            _input = torch.ones([1] + list(input_shape)).to(self.device)
+            _output = self(_input)
+            self.backbone.feature_dimensions_memo[key] = [
+                _output[layer].shape[1] for layer in self.layers_to_extract_from
+            ]
+        return list(self.backbone.feature_dimensions_memo[key])
+
+
+def _pruned_view(backbone, last_layer):
+    """Returns a shallow copy of backbone without the modules after last_layer.
+
+    Every module registered after last_layer is an identity in the copy,
+    the others (and their weights) are shared with backbone, which is left
+    unchanged. Relies on the backbone registering its children in execution
+    order (true for torchvision/timm ResNets, resnet.py and timm ViTs); the
+    pruned modules are never executed as the forward hook of last_layer
+    stops the forward pass.
+    """
+    extract_block, _, extract_idx = last_layer.partition(".")
+    view = copy.copy(backbone)
+    view._modules = type(backbone._modules)(backbone._modules)
+    names = list(view._modules.keys())
+    for name in names[names.index(extract_block) + 1:]:
+        view._modules[name] = torch.nn.Identity()
+    block = view._modules[extract_block]
+    if extract_idx.isnumeric() and isinstance(block, torch.nn.Sequential):
+        block = copy.copy(block)
+        block._modules = type(block._modules)(block._modules)
+        for idx in range(int(extract_idx) + 1, len(block)):
+            block[idx] = torch.nn.Identity()
+        view._modules[extract_block] = block
+    return view
 
 
 class ForwardHook:
-    def __init__(self, hook_dict, layer_name: str, last_layer_to_extract: str):
+    def __init__(self, hook_dict, layer_name: str, last_layer_to_extract: str, early_exit=True):
         self.hook_dict = hook_dict
         self.layer_name = layer_name
         self.raise_exception_to_break = copy.deepcopy(
-            layer_name == last_layer_to_extract
+            early_exit and layer_name == last_layer_to_extract
         )
 
     def __call__(self, module, input, output):
         self.hook_dict[self.layer_name] = output
-        # if self.raise_exception_to_break:
-        #     raise LastLayerToExtractReachedException()
+        if self.raise_exception_to_break:
+            raise LastLayerToExtractReachedException()
         return None
 
 
@@ -210,3 +884,119 @@ class LastLayerToExtractReachedException(Exception):
     pass
 
 
+
+
+class TruncatedBackbone(torch.nn.Module):
+    """The children of a backbone up to the last layer to extract from.
+
+    Returns the extracted feature maps by name. Unlike the hooks of
+    NetworkFeatureAggregator, its forward pass can be traced by torch.fx.
+    Like _pruned_view, it relies on the backbone
+    running its children one after the other in registration order (true
+    for torchvision ResNets and resnet.py). Layers inside a block are
+    given as "block.index" of a torch.nn.Sequential.
+    """
+
+    def __init__(self, backbone, layers_to_extract_from):
+        super(TruncatedBackbone, self).__init__()
+        self.layers_to_extract_from = list(layers_to_extract_from)
+        last_block, _, last_idx = self.layers_to_extract_from[-1].partition(".")
+        self.steps = torch.nn.ModuleList()
+        # Names of the layers whose output is the output of each step.
+        self.step_outputs = []
+        for name, child in backbone.named_children():
+            if any(layer.startswith(name + ".") for layer in self.layers_to_extract_from):
+                if not isinstance(child, torch.nn.Sequential):
+                    raise ValueError("Layers inside {} can not be traced.".format(name))
+                stop = int(last_idx) + 1 if name == last_block else len(child)
+                for idx in range(stop):
+                    self.steps.append(child[idx])
+                    self.step_outputs.append(["{}.{}".format(name, idx)])
+                if stop == len(child):
+                    self.step_outputs[-1].append(name)
+            else:
+                self.steps.append(child)
+                self.step_outputs.append([name])
+            if name == last_block:
+                break
+        missing = set(self.layers_to_extract_from) - {
+            layer for outputs in self.step_outputs for layer in outputs
+        }
+        if missing:
+            raise ValueError("Layers {} are not children of the backbone.".format(sorted(missing)))
+
+    def forward(self, images):
+        outputs = {}
+        features = images
+        for step, names in zip(self.steps, self.step_outputs):
+            features = step(features)
+            for name in names:
+                if name in self.layers_to_extract_from:
+                    outputs[name] = features
+        return outputs
+
+
+@contextlib.contextmanager
+def quantized_engine(backend=None):
+    """Selects the quantized engine of torch inside the block, None keeps the current one."""
+    previous = torch.backends.quantized.engine
+    if backend is not None:
+        torch.backends.quantized.engine = backend
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+def quantize_static(module, example_images, calibration_batches=(), backend=None):
+    """Returns a statically int8 quantized copy of module, made with torch.fx.
+
+    Activation ranges are observed on calibration_batches, an iterable of
+    image batches. Without any, the result only has the structure to load
+    the state_dict of a calibrated copy into. backend defaults to the
+    quantized engine of torch (x86/fbgemm on Intel and AMD, qnnpack on
+    ARM), run the result under quantized_engine(backend). Quantized models
+    run on the CPU only.
+    """
+    with quantized_engine(backend):
+        return _quantize_static(module, example_images, calibration_batches, torch.backends.quantized.engine)
+
+
+def _quantize_static(module, example_images, calibration_batches, backend):
+    from torch.ao import quantization
+    from torch.ao.quantization import quantize_fx
+
+    if hasattr(quantization, "get_default_qconfig_mapping"):
+        qconfig = quantization.get_default_qconfig_mapping(backend)
+    else:
+        # torch < 1.13
+        qconfig = {"": quantization.get_default_qconfig(backend)}
+
+    module = copy.deepcopy(module).cpu().eval()
+    for submodule in module.modules():
+        # Hooks such as the ForwardHooks of NetworkFeatureAggregator.
+        submodule._forward_hooks.clear()
+    try:
+        prepared = quantize_fx.prepare_fx(module, qconfig, example_inputs=(example_images.cpu(),))
+    except TypeError:
+        # torch < 1.13
+        prepared = quantize_fx.prepare_fx(module, qconfig)
+    calibrated = False
+    with torch.no_grad():
+        for images in calibration_batches:
+            prepared(images.to(torch.float).cpu())
+            calibrated = True
+    with warnings.catch_warnings():
+        if not calibrated:
+            # Observers that have seen no data warn about their default ranges.
+            warnings.simplefilter("ignore")
+        return quantize_fx.convert_fx(prepared)
+
+
+def quantize_dynamic(module):
+    """Returns a copy of module whose Linear layers run with int8 weights and dynamically quantized inputs."""
+    from torch.ao import quantization
+
+    return quantization.quantize_dynamic(
+        copy.deepcopy(module).cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
@@ -109,6 +109,14 @@ class MVTecDataset(torch.utils.data.Dataset):
 
         self.imagesize = (3, imagesize, imagesize)
 
+        # Images map to the same tensor on every pass only if no random
+        # augmentation is active, which is what feature caching relies on.
+        self.deterministic = not kwargs.get("augment", False) and not any([
+            rotate_degrees, translate, brightness_factor, contrast_factor,
+            saturation_factor, gray_p, h_flip_p, v_flip_p, scale,
+        ])
+        self.transform_key = "resize={}-imagesize={}".format(resize, imagesize)
+
 
     def __getitem__(self, idx):
         classname, anomaly, image_path, mask_path = self.data_to_iterate[idx]
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import PIL
+import torch
+from torchvision import transforms
+
+_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+class SourceImageDataset(torch.utils.data.Dataset):
+    """
+    PyTorch Dataset for the source domain of domain adaptation (e.g. a
+    folder of ImageNet sample images). Images are decoded lazily, so only
+    the batches in flight are held in memory.
+    """
+
+    def __init__(self, source, size=0, resize=256, cropsize=227, seed=0):
+        """
+        Args:
+            source: [str]. Path to a folder of images.
+            size: [int]. Number of images to use. A random subset of this
+                  size is drawn if the folder holds more images, 0 uses all.
+            resize: [int]. (Square) Size the loaded image initially gets
+                    resized to.
+            cropsize: [int]. (Square) Size of the random crop taken from the
+                      resized image.
+            seed: [int]. Seed of the subset selection.
+        """
+        super().__init__()
+        self.source = source
+        self.image_paths = sorted(
+            os.path.join(source, x)
+            for x in os.listdir(source)
+            if x.lower().endswith(_IMAGE_EXTENSIONS)
+        )
+        if 0 < size < len(self.image_paths):
+            idxs = np.random.RandomState(seed).choice(len(self.image_paths), size, replace=False)
+            self.image_paths = [self.image_paths[i] for i in sorted(idxs)]
+
+        self.transform_img = transforms.Compose([
+            transforms.Resize(resize),
+            transforms.RandomCrop(cropsize),
+            transforms.ToTensor(),
+        ])
+
+    def __getitem__(self, idx):
+        image_path = self.image_paths[idx]
+        image = PIL.Image.open(image_path).convert("RGB")
+        return {
+            "image": self.transform_img(image),
+            "image_path": image_path,
+        }
+
+    def __len__(self):
+        return len(self.image_paths)
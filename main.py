@@ -5,9 +5,13 @@
 # The script is based on the code of PatchCore (https://github.com/amazon-science/patchcore-inspection)
 # ------------------------------------------------------------------
 
+import copy
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import sys
+import traceback
 
 import click
 import numpy as np
@@ -19,6 +23,7 @@ import common
 import metrics
 import simplenet 
 import utils
+from datasets import source
 
 LOGGER = logging.getLogger(__name__)
 
@@ -37,10 +42,65 @@ _DATASETS = {
 @click.option("--run_name", type=str, default="test")
 @click.option("--test", is_flag=True)
 @click.option("--save_segmentation_images", is_flag=True, default=False, show_default=True)
+@click.option("--workers", type=int, default=0, show_default=True, help="Subdatasets trained in parallel processes, 0 trains them one by one.")
 def main(**kwargs):
     pass
 
 
+def _worker(conn, fn, args):
+    try:
+        result = ("ok", fn(*args))
+    except BaseException:
+        result = ("error", traceback.format_exc())
+    conn.send(result)
+    conn.close()
+
+
+def _run_in_workers(fn, tasks, workers):
+    """Calls fn(*task, slot) for every task in at most `workers` forked processes.
+
+    slot is the index of the worker slot the task runs in, in
+    [0, workers). Forking lets the tasks share everything the parent
+    loaded, e.g. backbones moved to shared memory. Returns a list with one
+    ("ok", result) or ("error", message) per task, so that a failing or
+    crashing task does not take down the others.
+    """
+    context = multiprocessing.get_context("fork")
+    outcomes = [None] * len(tasks)
+    pending = list(enumerate(tasks))
+    running = {}
+    free_slots = list(range(workers))
+    while pending or running:
+        while pending and free_slots:
+            index, task = pending.pop(0)
+            slot = free_slots.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_worker, args=(sender, fn, tuple(task) + (slot,)))
+            process.start()
+            sender.close()
+            running[process.sentinel] = (index, slot, process, receiver)
+
+        multiprocessing.connection.wait(
+            [receiver for _, _, _, receiver in running.values()] + list(running.keys())
+        )
+        for sentinel, (index, slot, process, receiver) in list(running.items()):
+            if outcomes[index] is None and receiver.poll():
+                try:
+                    outcomes[index] = receiver.recv()
+                except EOFError:
+                    pass
+            if not process.is_alive():
+                process.join()
+                if outcomes[index] is None:
+                    outcomes[index] = (
+                        "error", "worker exited with code {}".format(process.exitcode)
+                    )
+                receiver.close()
+                free_slots.append(slot)
+                del running[sentinel]
+    return outcomes
+
+
 @main.result_callback()
 def run(
     methods,
@@ -51,8 +111,14 @@ def run(
     log_project,
     run_name,
     test,
-    save_segmentation_images
+    save_segmentation_images,
+    workers,
 ):
+    # A command returns one (key, method) tuple or a list of them.
+    methods = [
+        method for result in methods
+        for method in (result if isinstance(result, list) else [result])
+    ]
     methods = {key: item for (key, item) in methods} #튜플 리스트를 딕셔너리로 받아서 더 잘 작동할 수 있도록 
 
     run_save_path = utils.create_storage_folder(
@@ -64,8 +130,7 @@ def run(
 
     device = utils.set_torch_device(gpu)
 
-    result_collect = []
-    for dataloader_count, dataloaders in enumerate(list_of_dataloaders):
+    def run_subdataset(dataloader_count, dataloaders, device):
         LOGGER.info(
             "Evaluating dataset [{}] ({}/{})...".format(
                 dataloaders["training"].name,
@@ -83,6 +148,7 @@ def run(
 
         models_dir = os.path.join(run_save_path, "models")
         os.makedirs(models_dir, exist_ok=True)
+        results = []
         for i, SimpleNet in enumerate(simplenet_list):
             # torch.cuda.empty_cache()
             if SimpleNet.backbone.seed is not None:
@@ -94,15 +160,17 @@ def run(
 
             SimpleNet.set_model_dir(os.path.join(models_dir, f"{i}"), dataset_name)
             ########################revised for ad check###############################
-            #SimpleNet.ad_model_dir(os.path.join("/home/smk/data/project/SimpleNetrevised_copy/domainr_carpet", f"{i}"), dataset_name)
-            SimpleNet.ad_model_dir(os.path.join("/home/smk/data/project/SimpleNetrevised_copy/domainresults_600", f"{i}"), dataset_name)
+            if "run_domain_adaptation" in methods:
+                methods["run_domain_adaptation"](
+                    SimpleNet, dataloaders, os.path.join(run_save_path, "domain", f"{i}")
+                )
             if not test:
                 i_auroc, p_auroc, pro_auroc = SimpleNet.train(dataloaders["training"], dataloaders["testing"])
             else:
                 i_auroc, p_auroc, pro_auroc =  SimpleNet.test(dataloaders["training"], dataloaders["testing"], save_segmentation_images)
 
 
-            result_collect.append(
+            results.append(
                 {
                     "dataset_name": dataset_name,
                     "instance_auroc": i_auroc, # auroc,
@@ -111,11 +179,41 @@ def run(
                 }
             )
 
-            for key, item in result_collect[-1].items():
+            for key, item in results[-1].items():
                 if key != "dataset_name":
                     LOGGER.info("{0}: {1:3.3f}".format(key, item))
 
         LOGGER.info("\n\n-----\n")
+        return results
+
+    result_collect = []
+    if workers > 0:
+        # Load every backbone once in shared memory before forking.
+        methods["load_backbones"]()
+        backbones.share_memory()
+        # The workers split the cores instead of each starting a thread per core.
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+        def run_in_slot(dataloader_count, dataloaders, slot):
+            torch.set_num_threads(threads_per_worker)
+            slot_device = utils.set_torch_device([gpu[slot % len(gpu)]] if len(gpu) else [])
+            return run_subdataset(dataloader_count, dataloaders, slot_device)
+
+        outcomes = _run_in_workers(
+            run_in_slot, list(enumerate(list_of_dataloaders)), workers
+        )
+        for dataloaders, (status, outcome) in zip(list_of_dataloaders, outcomes):
+            if status == "ok":
+                result_collect.extend(outcome)
+            else:
+                LOGGER.error(
+                    "Dataset [{}] failed:\n{}".format(dataloaders["training"].name, outcome)
+                )
+        if not result_collect:
+            raise RuntimeError("Training failed for all datasets.")
+    else:
+        for dataloader_count, dataloaders in enumerate(list_of_dataloaders):
+            result_collect.extend(run_subdataset(dataloader_count, dataloaders, device))
 
     # Store all results and mean scores to a csv-file.
     result_metric_names = list(result_collect[-1].keys())[1:]
@@ -134,6 +232,9 @@ def run(
 #revised
 #@click.option("--backbone_names2", "-b", type=str, multiple=True, default=[])
 @click.option("--layers_to_extract_from", "-le", type=str, multiple=True, default=[])
+@click.option("--backbone_weights", type=click.Path(exists=True, dir_okay=False), multiple=True, default=[], help="Local state_dict per backbone, in the order of -b, instead of downloading weights.")
+@click.option("--weight_store", type=click.Path(file_okay=False), default=None, help="Local weight store (see backbones.py) to take backbone weights from.")
+@click.option("--verify_weights", is_flag=True, help="Check the sha256 of weights taken from --weight_store against its manifest.")
 @click.option("--pretrain_embed_dimension", type=int, default=1024)
 @click.option("--target_embed_dimension", type=int, default=1024)
 @click.option("--patchsize", type=int, default=3)
@@ -152,10 +253,32 @@ def run(
 @click.option("--pre_proj", type=int, default=0)
 @click.option("--proj_layer_type", type=int, default=0)
 @click.option("--mix_noise", type=int, default=1)
+@click.option("--backbone_truncation", type=click.Choice(["exit", "prune", "none"]), default="exit", show_default=True)
+@click.option("--feature_cache", is_flag=True)
+@click.option("--feature_cache_mb", type=int, default=4096, show_default=True)
+@click.option("--feature_cache_dir", type=str, default=None)
+@click.option("--pixel_metric_bins", type=int, default=0, show_default=True)
+@click.option("--seg_normalization", type=click.Choice(["mean_affine", "per_image", "global"]), default="mean_affine", show_default=True)
+@click.option("--ckpt_keep_last", type=int, default=0, show_default=True)
+@click.option("--resume", is_flag=True)
+@click.option("--eval_every", type=int, default=1, show_default=True)
+@click.option("--patience", type=int, default=0, show_default=True)
+@click.option("--noise_seed", type=int, default=None, help="Seed of the synthetic anomaly noise, the global RNG is used if not set.")
+@click.option("--no_tensorboard", is_flag=True, help="Do not write TensorBoard logs.")
+@click.option("--log_every", type=int, default=50, show_default=True, help="Iterations between TensorBoard writes of discriminator statistics.")
+@click.option("--inference_precision", type=click.Choice(["fp32", "bf16", "fp16"]), default="fp32", show_default=True, help="Autocast dtype of the backbone and embedding at prediction.")
+@click.option("--channels_last", is_flag=True, help="Run the frozen backbone in channels_last memory format.")
+@click.option("--compile_backbone", is_flag=True, help="Run the frozen backbone through torch.compile.")
+@click.option("--quantize", is_flag=True, help="With --test, predict on the CPU with int8 backbone and heads, stored as ckpt_int8.pth.")
+@click.option("--quantization_batches", type=int, default=8, show_default=True, help="Training batches that calibrate the int8 backbone.")
+@click.option("--embed_engine", type=click.Choice(["unfold", "fused", "linear"]), default="unfold", show_default=True)
 
 def net(
     backbone_names,
     layers_to_extract_from,
+    backbone_weights,
+    weight_store,
+    verify_weights,
     pretrain_embed_dimension,
     target_embed_dimension,
     patchsize,
@@ -174,6 +297,25 @@ def net(
     pre_proj,
     proj_layer_type,
     mix_noise,
+    backbone_truncation,
+    feature_cache,
+    feature_cache_mb,
+    feature_cache_dir,
+    pixel_metric_bins,
+    seg_normalization,
+    ckpt_keep_last,
+    resume,
+    eval_every,
+    patience,
+    embed_engine,
+    noise_seed,
+    no_tensorboard,
+    log_every,
+    inference_precision,
+    channels_last,
+    compile_backbone,
+    quantize,
+    quantization_batches,
 ):
     backbone_names = list(backbone_names)
     if len(backbone_names) > 1:
@@ -184,19 +326,39 @@ def net(
             layers_to_extract_from_coll[idx].append(layer)
     else:
         layers_to_extract_from_coll = [layers_to_extract_from]
+    if backbone_weights and len(backbone_weights) != len(backbone_names):
+        raise click.BadParameter(
+            "give one path per backbone", param_hint="--backbone_weights"
+        )
+    weights_paths = list(backbone_weights) or [None] * len(backbone_names)
+    backbone_specs = []
+    for backbone_name in backbone_names:
+        backbone_seed = None
+        if ".seed-" in backbone_name:
+            backbone_name, backbone_seed = backbone_name.split(".seed-")[0], int(
+                backbone_name.split("-")[-1]
+            )
+        backbone_specs.append((backbone_name, backbone_seed))
+
+    def load_backbones():
+        """Loads every configured backbone into the backbones.get registry."""
+        for (backbone_name, backbone_seed), weights_path in zip(backbone_specs, weights_paths):
+            backbones.get(backbone_name, backbone_seed, weights_path, weight_store, verify_weights)
 
     def get_simplenet(input_shape, device):
+        """Builds one SimpleNet per backbone.
+
+        Backbones are shared through backbones.get, so each is loaded once
+        per process. A backbone that gets trained is copied first, so that
+        the shared weights stay untouched.
+        """
         simplenets = []
-        for backbone_name, layers_to_extract_from in zip(
-            backbone_names, layers_to_extract_from_coll
+        for (backbone_name, backbone_seed), layers_to_extract_from, weights_path in zip(
+            backbone_specs, layers_to_extract_from_coll, weights_paths
         ):
-            backbone_seed = None
-            if ".seed-" in backbone_name:
-                backbone_name, backbone_seed = backbone_name.split(".seed-")[0], int(
-                    backbone_name.split("-")[-1]
-                )
-            backbone = backbones.load(backbone_name)
-            backbone.name, backbone.seed = backbone_name, backbone_seed
+            backbone = backbones.get(backbone_name, backbone_seed, weights_path, weight_store, verify_weights)
+            if train_backbone:
+                backbone = copy.deepcopy(backbone).requires_grad_(True)
             #print(device)
             #fq
             simplenet_inst = simplenet.SimpleNet(device)
@@ -223,11 +385,65 @@ def net(
                 pre_proj=pre_proj,
                 proj_layer_type=proj_layer_type,
                 mix_noise=mix_noise,
+                backbone_truncation=backbone_truncation,
+                feature_cache=feature_cache,
+                feature_cache_memory=feature_cache_mb * 2**20,
+                feature_cache_dir=feature_cache_dir,
+                pixel_metric_bins=pixel_metric_bins,
+                seg_normalization=seg_normalization,
+                ckpt_keep_last=ckpt_keep_last,
+                resume=resume,
+                eval_every=eval_every,
+                patience=patience,
+                embed_engine=embed_engine,
+                noise_seed=noise_seed,
+                tensorboard=not no_tensorboard,
+                log_every=log_every,
+                inference_precision=inference_precision,
+                channels_last=channels_last,
+                compile_backbone=compile_backbone,
+                quantize_int8=quantize,
+                quantization_batches=quantization_batches,
             )
             simplenets.append(simplenet_inst)
         return simplenets
 
-    return ("get_simplenet", get_simplenet)
+    return [("get_simplenet", get_simplenet), ("load_backbones", load_backbones)]
+
+@main.command("domain")
+@click.option("--epochs", type=int, default=600, show_default=True)
+@click.option("--lr", type=float, default=1e-3, show_default=True)
+@click.option("--momentum", type=float, default=0.9, show_default=True)
+@click.option("--lam", type=float, default=0.01, show_default=True)
+@click.option(
+    "--views", type=int, default=0, show_default=True,
+    help="Random-crop views per image embedded once and cached in RAM instead of re-running the backbone "
+    "every epoch. 0 streams both domains, memory then does not grow with their size. The float16 cache "
+    "costs about 4 MB (36x36 patches x 1536 dims) per image and view for wideresnet50 layer2+layer3 at 288px (source and target).",
+)
+@click.option("--artifact_dir", type=str, default=None)
+def domain(epochs, lr, momentum, lam, views, artifact_dir):
+    """Trains the domain classifier once per backbone, layers and data.
+
+    The artifact is reused by later runs with the same artifact_dir.
+    """
+
+    def run_domain_adaptation(simplenet_inst, dataloaders, default_artifact_dir):
+        if dataloaders["source"] is None:
+            LOGGER.warning("No dataset --source_path given, skipping domain adaptation.")
+            return None
+        return simplenet_inst.domain_adaptation(
+            dataloaders["training"],
+            dataloaders["source"],
+            artifact_dir if artifact_dir is not None else default_artifact_dir,
+            epochs=epochs,
+            lr=lr,
+            momentum=momentum,
+            lam=lam,
+            views=views,
+        )
+
+    return ("run_domain_adaptation", run_domain_adaptation)
 
 ######################################여기서 데이터셋 불러와서 데이터로더 진행 ############################################
 @main.command("dataset")
@@ -249,6 +465,8 @@ def net(
 @click.option("--hflip", default=0.0, type=float)
 @click.option("--vflip", default=0.0, type=float)
 @click.option("--augment", is_flag=True)
+@click.option("--source_path", type=click.Path(exists=True, file_okay=False), default=None)
+@click.option("--source_size", default=0, type=int, show_default=True)
 def dataset(
     name,
     data_path,
@@ -268,6 +486,8 @@ def dataset(
     hflip,
     vflip,
     augment,
+    source_path,
+    source_size,
 ):
 
     dataset_info = _DATASETS[name]
@@ -277,6 +497,20 @@ def dataset(
     def get_dataloaders(seed):
         print('데이터로더 시작 !')
         dataloaders = []
+
+        # Source domain for domain adaptation, shared by all subdatasets.
+        source_dataloader = None
+        if source_path is not None:
+            source_dataset = source.SourceImageDataset(source_path, size=source_size, seed=seed)
+            LOGGER.info(f"Source dataset: {len(source_dataset)}")
+            source_dataloader = torch.utils.data.DataLoader(
+                source_dataset,
+                batch_size=batch_size,
+                shuffle=True,
+                num_workers=num_workers,
+                prefetch_factor=2,
+                pin_memory=True,
+            )
         print('mvtec')
         for subdataset in subdatasets:
             print('mv')
@@ -358,6 +592,7 @@ def dataset(
                 "training": train_dataloader,
                 "validation": val_dataloader,
                 "testing": test_dataloader,
+                "source": source_dataloader,
             }
 
             dataloaders.append(dataloader_dict)
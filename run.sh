@@ -1,5 +1,5 @@
 datapath=/home/smk/data/project/MVTec
-#datapathtoimagenet=/home/smk/data/dataset/imagenet-sample-images-master
+datapathtoimagenet=/home/smk/data/dataset/imagenet-sample-images-master
 datasets=('screw' 'pill' 'capsule' 'carpet' 'grid' 'tile' 'wood' 'zipper' 'cable' 'toothbrush' 'transistor' 'metal_nut' 'bottle' 'hazelnut' 'leather')
 dataset_flags=($(for dataset in "${datasets[@]}"; do echo '-d '"${dataset}"; done))
 
@@ -30,7 +30,10 @@ net \
 --dsc_layers 2 \
 --dsc_margin .5 \
 --pre_proj 1 \
+domain \
+--epochs 600 \
 dataset \
 --batch_size 8 \
 --resize 329 \
---imagesize 288 "${dataset_flags[@]}" mvtec $datapath
+--imagesize 288 \
+--source_path $datapathtoimagenet "${dataset_flags[@]}" mvtec $datapath
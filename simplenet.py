@@ -6,9 +6,13 @@
 # ------------------------------------------------------------------
 
 """detection methods."""
+import hashlib
+import itertools
+import json
 import logging
 import os
 import pickle
+import random
 from collections import OrderedDict
 from PIL import Image
 
@@ -29,7 +33,7 @@ from torchvision.io import read_image
 import common
 import metrics
 
-from utils import plot_segmentation_images
+from utils import CheckpointWriter, EarlyStopping, MetricsBuffer, plot_segmentation_images
 
 from torchvision import transforms, datasets
 from torch.utils.data import DataLoader
@@ -100,6 +104,44 @@ class Projection(torch.nn.Module):
         x = self.layers(x)
         return x
 
+class NoiseGenerator:
+    """Gaussian noise for synthetic anomalous features, sampled on the device.
+
+    Every row is drawn with the std of one of mix_noise scales
+    noise_std * 1.1**k, chosen uniformly. With a seed the noise comes from
+    a generator of its own and is reproducible independent of the global
+    RNG.
+    """
+
+    def __init__(self, noise_std, mix_noise=1, device="cpu", seed=None):
+        self.mix_noise = mix_noise
+        self.device = torch.device(device)
+        self.stds = torch.tensor(
+            [noise_std * 1.1**k for k in range(mix_noise)], device=self.device
+        )
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator(device=self.device)
+            self.generator.manual_seed(seed)
+
+    def __call__(self, shape, dtype=torch.float32):
+        """Returns noise of shape n_rows x channels."""
+        noise = torch.randn(shape, generator=self.generator, device=self.device, dtype=dtype)
+        if self.mix_noise == 1:
+            return noise.mul_(self.stds[0].to(dtype))
+        noise_idxs = torch.randint(
+            0, self.mix_noise, (shape[0],), generator=self.generator, device=self.device
+        )
+        return noise.mul_(self.stds[noise_idxs].to(dtype).unsqueeze(-1))
+
+    def get_state(self):
+        return None if self.generator is None else self.generator.get_state()
+
+    def set_state(self, state):
+        if self.generator is not None and state is not None:
+            self.generator.set_state(state)
+
+
 #### domain classifier 추가 
 class DomainClassifier(nn.Module):
 
@@ -121,33 +163,18 @@ class DomainClassifier(nn.Module):
 
 class TBWrapper:
     
-    def __init__(self, log_dir):
+    def __init__(self, log_dir, enabled=True):
         self.g_iter = 0
-        self.logger = SummaryWriter(log_dir=log_dir)
+        self.logger = SummaryWriter(log_dir=log_dir) if enabled else None
     
     def step(self):
         self.g_iter += 1
 
+    def add_scalar(self, tag, value, step=None):
+        """Writes a scalar at step (default the current iteration), if TensorBoard is enabled."""
+        if self.logger is not None:
+            self.logger.add_scalar(tag, value, self.g_iter if step is None else step)
 
-class CustomImageDataset(torch.utils.data.Dataset):
-    def __init__(self, root_dir, transform=None):
-        self.root_dir = root_dir
-        self.transform = transform
-        self.images = os.listdir(root_dir)
-
-    def __len__(self):
-        return len(self.images)
-
-    
-    def __getitem__(self, idx):
-        img_name = os.path.join(self.root_dir, self.images[idx])
-        image = Image.open(img_name).convert("RGB")
-
-        if self.transform:
-            image = self.transform(image)
-
-        return image
-    
 
 def acc_fn(pred, true):
     #accuracy = torch.eq(pred, true).sum().item() / len(pred)
@@ -155,6 +182,18 @@ def acc_fn(pred, true):
     #print(f"true size: {true.size()}")
     accuracy = torch.eq(pred.argmax(dim=1), true).sum().item() / len(pred)
     return accuracy
+
+
+def _cpu_copy(obj):
+    """Copies all tensors in nested dicts/lists/tuples to the CPU."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return obj.__class__((k, _cpu_copy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_cpu_copy(v) for v in obj)
+    return obj
+
     
 class SimpleNet(torch.nn.Module):
     def __init__(self, device):
@@ -189,6 +228,25 @@ class SimpleNet(torch.nn.Module):
         lr=1e-3,
         pre_proj=0, # 1
         proj_layer_type=0,
+        backbone_truncation="exit",
+        feature_cache=False,
+        feature_cache_memory=2**32,
+        feature_cache_dir=None,
+        pixel_metric_bins=0,
+        seg_normalization="mean_affine",
+        ckpt_keep_last=0,
+        resume=False,
+        eval_every=1,
+        patience=0,
+        embed_engine="unfold",
+        noise_seed=None,
+        tensorboard=True,
+        log_every=50,
+        inference_precision="fp32",
+        channels_last=False,
+        compile_backbone=False,
+        quantize_int8=False,
+        quantization_batches=8,
         **kwargs,
     ):
         pid = os.getpid()
@@ -206,7 +264,8 @@ class SimpleNet(torch.nn.Module):
         self.forward_modules = torch.nn.ModuleDict({})
 
         feature_aggregator = common.NetworkFeatureAggregator( #patchcore 방식으로 feature 를 추출하는 방법
-            self.backbone, self.layers_to_extract_from, self.device, train_backbone
+            self.backbone, self.layers_to_extract_from, self.device, train_backbone,
+            truncate=backbone_truncation,
         )
         feature_dimensions = feature_aggregator.feature_dimensions(input_shape) #input-size 값으로 feature 크기를 맞춰줌
         self.forward_modules["feature_aggregator"] = feature_aggregator
@@ -225,6 +284,26 @@ class SimpleNet(torch.nn.Module):
 
         self.forward_modules["preadapt_aggregator"] = preadapt_aggregator
 
+        # "fused" replaces patchify + Preprocessing, see common.PatchPooling,
+        # "linear" also the preadapt_aggregator and, at inference, a linear
+        # pre_projection, see common.LinearPatchEmbedding.
+        self.embed_engine = embed_engine
+        if embed_engine == "fused":
+            stages = common.PatchPooling(
+                feature_dimensions, pretrain_embed_dimension, preadapt_aggregator,
+                patchsize, patchstride,
+            ).to(self.device)
+        elif embed_engine == "linear":
+            input_dims = [dim * patchsize ** 2 for dim in feature_dimensions]
+            layer_maps = common.linear_map(
+                lambda features: preadapt_aggregator(preprocessing(features)), input_dims
+            )
+            stages = common.LinearPatchEmbedding(
+                layer_maps, feature_dimensions, patchsize, patchstride
+            ).to(self.device)
+        else:
+            stages = common.UnfoldPatchStages(self.patch_maker, preprocessing, preadapt_aggregator)
+
         self.anomaly_segmentor = common.RescaleSegmentor(
             device=self.device, target_size=input_shape[-2:]
         )
@@ -245,6 +324,23 @@ class SimpleNet(torch.nn.Module):
             self.pre_projection.to(self.device)
             self.proj_opt = torch.optim.AdamW(self.pre_projection.parameters(), lr*.1)
 
+        # Used for training, domain adaptation and prediction alike.
+        self.embedding_engine = common.EmbeddingEngine(
+            feature_aggregator, self.layers_to_extract_from, stages,
+            self.pre_projection if self.pre_proj > 0 else None, train_backbone,
+        )
+        self.set_inference_mode(inference_precision, channels_last, compile_backbone)
+        # test() predicts with int8 copies of the backbone and heads,
+        # calibrated on quantization_batches batches of the training data.
+        self.quantize_int8 = quantize_int8
+        self.quantization_batches = quantization_batches
+        self.quantized_discriminator = None
+        self.quantized_projection = None
+        # Quantized engine of torch the int8 modules were made for, and the
+        # settings they depend on, see _quantization_config.
+        self.quantized_engine = None
+        self.quantization_config = None
+
         # Discriminator
         self.auto_noise = [auto_noise, None]
         self.dsc_lr = dsc_lr
@@ -252,35 +348,176 @@ class SimpleNet(torch.nn.Module):
         self.mix_noise = mix_noise
         self.noise_type = noise_type
         self.noise_std = noise_std
+        self.noise_generator = NoiseGenerator(noise_std, mix_noise, self.device, noise_seed)
         self.discriminator = Discriminator(self.target_embed_dimension, n_layers=dsc_layers, hidden=dsc_hidden)
         self.discriminator.to(self.device)
         self.dsc_opt = torch.optim.Adam(self.discriminator.parameters(), lr=self.dsc_lr, weight_decay=1e-5)
         self.dsc_schl = torch.optim.lr_scheduler.CosineAnnealingLR(self.dsc_opt, (meta_epochs - aed_meta_epochs) * gan_epochs, self.dsc_lr*.4)
         self.dsc_margin= dsc_margin 
 
+        # Number of histogram bins for streaming pixel metrics, 0 is exact.
+        self.pixel_metric_bins = pixel_metric_bins
+        # How segmentations are normalized for PRO, see metrics.normalize_segmentations.
+        self.seg_normalization = seg_normalization
+        # Number of improving meta-epoch snapshots kept next to best.pth.
+        self.ckpt_keep_last = ckpt_keep_last
+        # Continue an interrupted run from its train_state.pth.
+        self.resume = resume
+        # Evaluate every eval_every meta epochs, stop after patience
+        # evaluations without improvement (0 never stops).
+        self.eval_every = eval_every
+        self.patience = patience
+        # Discriminator statistics are written to TensorBoard every
+        # log_every iterations, see utils.MetricsBuffer.
+        self.tensorboard = tensorboard
+        self.log_every = log_every
+
+        # Embeddings of the frozen backbone, reused across gan/meta epochs.
+        self.feature_cache = None
+        if feature_cache:
+            self.feature_cache = common.FeatureCache(feature_cache_memory, feature_cache_dir)
+
         self.model_dir = ""
         self.dataset_name = ""
         self.tau = 1
         self.logger = None
+        self.domain_classifier = None
+
+    def set_inference_mode(self, precision="fp32", channels_last=False, compile_backbone=False):
+        """Selects how embeddings are computed for prediction.
+
+        precision ("fp32", "bf16" or "fp16") is the autocast dtype of the
+        backbone and the embedding stages in _predict, channels_last and
+        compile_backbone apply to every pass of a frozen backbone.
+        """
+        self.embedding_engine.precision = precision
+        self.forward_modules["feature_aggregator"].set_inference_mode(channels_last, compile_backbone)
+
+    def _quantization_config(self, n_batches, backend):
+        """Returns the settings that int8 modules made by quantize depend on."""
+        return {
+            "backend": backend,
+            "layers_to_extract_from": list(self.layers_to_extract_from),
+            "input_shape": list(self.input_shape),
+            "embed_engine": self.embed_engine,
+            "pre_proj": self.pre_proj,
+            "calibration_batches": n_batches,
+        }
+
+    def quantize(self, calibration_data=None, n_batches=None, backend=None):
+        """Switches _predict to int8 copies of the backbone, discriminator and pre_projection.
+
+        The backbone is quantized statically, its activation ranges are
+        observed on n_batches (default quantization_batches) batches of
+        calibration_data, a dataloader of training images. The Linear
+        layers of the heads are quantized dynamically. A pre_projection
+        folded into the "linear" embed engine is kept in float, it costs
+        nothing there. Without calibration_data, the int8 modules are only
+        built for load_quantized. backend is the quantized engine of torch
+        to quantize for, by default the current one. int8 inference runs on
+        the CPU only.
+        """
+        if torch.device(self.device).type != "cpu":
+            raise ValueError("int8 inference runs on the CPU only, got device {}.".format(self.device))
+        if self.train_backbone:
+            raise ValueError("A backbone that is trained can not be quantized.")
+        n_batches = self.quantization_batches if n_batches is None else n_batches
+        backend = backend or torch.backends.quantized.engine
+        calibration_batches = []
+        if calibration_data is not None:
+            for data in itertools.islice(calibration_data, n_batches):
+                calibration_batches.append(data["image"] if isinstance(data, dict) else data)
+        with common.quantized_engine(backend):
+            self.forward_modules["feature_aggregator"].quantize(
+                torch.zeros([1] + list(self.input_shape)), calibration_batches, backend
+            )
+            self.quantized_discriminator = common.quantize_dynamic(self.discriminator)
+            self.quantized_projection = None
+            self.embedding_engine.projection = self.pre_projection if self.pre_proj > 0 else None
+            if self.pre_proj > 0 and not getattr(self.embedding_engine.stages, "folds_projection", False):
+                self.quantized_projection = common.quantize_dynamic(self.pre_projection)
+                self.embedding_engine.projection = self.quantized_projection
+        self.quantized_engine = backend
+        self.quantization_config = self._quantization_config(n_batches, backend)
+
+    def export_quantized(self, save_path):
+        """Saves the int8 modules made by quantize, and their settings, to save_path."""
+        state_dicts = {
+            "config": self.quantization_config,
+            "backbone": self.forward_modules["feature_aggregator"].quantized_backbone.state_dict(),
+            "discriminator": self.quantized_discriminator.state_dict(),
+        }
+        if self.quantized_projection is not None:
+            state_dicts["pre_projection"] = self.quantized_projection.state_dict()
+        torch.save(state_dicts, save_path + ".tmp")
+        os.replace(save_path + ".tmp", save_path)
+
+    def load_quantized(self, load_path):
+        """Switches _predict to the int8 modules saved by export_quantized.
+
+        Raises a ValueError if they were made for other settings of the net.
+        """
+        self._load_quantized_state(torch.load(load_path, map_location="cpu"), load_path)
+
+    def _load_quantized_state(self, state_dicts, load_path):
+        config = state_dicts.get("config")
+        if config is None:
+            raise ValueError("{} has no quantization settings, export it again.".format(load_path))
+        expected = self._quantization_config(config["calibration_batches"], config["backend"])
+        if config != expected:
+            raise ValueError(
+                "{} was quantized for {}, this net has {}.".format(load_path, config, expected)
+            )
+        self.quantize(n_batches=config["calibration_batches"], backend=config["backend"])
+        with common.quantized_engine(self.quantized_engine):
+            self.forward_modules["feature_aggregator"].quantized_backbone.load_state_dict(state_dicts["backbone"])
+            self.quantized_discriminator.load_state_dict(state_dicts["discriminator"])
+            if self.quantized_projection is not None:
+                self.quantized_projection.load_state_dict(state_dicts["pre_projection"])
+        self.quantization_config = config
+
+    def _use_quantized(self, calibration_data):
+        """Loads ckpt_int8.pth, or quantizes and exports it.
+
+        The file is made again if ckpt.pth is newer or if it was quantized
+        with other settings (backend, layers, input shape, embed engine,
+        pre_projection or number of calibration batches).
+        """
+        int8_path = os.path.join(self.ckpt_dir, "ckpt_int8.pth")
+        ckpt_path = os.path.join(self.ckpt_dir, "ckpt.pth")
+        expected = self._quantization_config(self.quantization_batches, torch.backends.quantized.engine)
+        state_dicts = None
+        if os.path.exists(int8_path) and (
+            not os.path.exists(ckpt_path) or os.path.getmtime(int8_path) >= os.path.getmtime(ckpt_path)
+        ):
+            state_dicts = torch.load(int8_path, map_location="cpu")
+        if state_dicts is not None and state_dicts.get("config") == expected:
+            self._load_quantized_state(state_dicts, int8_path)
+        else:
+            self.quantize(calibration_data)
+            self.export_quantized(int8_path)
 
     def set_model_dir(self, model_dir, dataset_name):
 
+        self.dataset_name = dataset_name
         self.model_dir = model_dir 
         os.makedirs(self.model_dir, exist_ok=True)
         self.ckpt_dir = os.path.join(self.model_dir, dataset_name)
         os.makedirs(self.ckpt_dir, exist_ok=True)
         self.tb_dir = os.path.join(self.ckpt_dir, "tb")
-        os.makedirs(self.tb_dir, exist_ok=True)
-        self.logger = TBWrapper(self.tb_dir) #SummaryWriter(log_dir=tb_dir)
+        if self.tensorboard:
+            os.makedirs(self.tb_dir, exist_ok=True)
+        self.logger = TBWrapper(self.tb_dir, self.tensorboard) #SummaryWriter(log_dir=tb_dir)
 
     def ad_model_dir(self, model_dir, dataset_name):
-            self.ad_model_dir = model_dir 
-            os.makedirs(self.ad_model_dir, exist_ok=True)
-            self.ad_ckpt_dir = os.path.join(self.ad_model_dir, dataset_name)
+            self.ad_model_root = model_dir 
+            os.makedirs(self.ad_model_root, exist_ok=True)
+            self.ad_ckpt_dir = os.path.join(self.ad_model_root, dataset_name)
             os.makedirs(self.ad_ckpt_dir, exist_ok=True)
             self.ad_tb_dir = os.path.join(self.ad_ckpt_dir, "tb")
-            os.makedirs(self.ad_tb_dir, exist_ok=True)
-            self.ad_logger = TBWrapper(self.ad_tb_dir) #SummaryWriter(log_dir=tb_dir)
+            if self.tensorboard:
+                os.makedirs(self.ad_tb_dir, exist_ok=True)
+            self.ad_logger = TBWrapper(self.ad_tb_dir, self.tensorboard) #SummaryWriter(log_dir=tb_dir)
 
 
     def embed(self, data):
@@ -297,73 +534,51 @@ class SimpleNet(torch.nn.Module):
             return features
         return self._embed(data)
 
-    def _embed(self, images, detach=True, provide_patch_shapes=False, evaluation=False):
-        """Returns feature embeddings for images."""
-
+    def _embed(self, images, detach=True, provide_patch_shapes=False, evaluation=False, project=False):
+        """Returns feature embeddings for images, passed through pre_projection if project."""
+        return self.embedding_engine(images, evaluation, project)
 
+    def _training_features(self, input_data):
+        """Yields the embeddings of every training batch.
 
-        B = len(images)
-        if not evaluation and self.train_backbone:
-            self.forward_modules["feature_aggregator"].train() #여기서 피처값 뽑히고 학습 진행 (프리트레인된 모델로)
-            features = self.forward_modules["feature_aggregator"](images, eval=evaluation)
-        else:
-            _ = self.forward_modules["feature_aggregator"].eval()
-            with torch.no_grad():
-                features = self.forward_modules["feature_aggregator"](images)
-
-        features = [features[layer] for layer in self.layers_to_extract_from]
-   
-
-        for i, feat in enumerate(features):
-            if len(feat.shape) == 3:
-                B, L, C = feat.shape
-                features[i] = feat.reshape(B, int(math.sqrt(L)), int(math.sqrt(L)), C).permute(0, 3, 1, 2)
-
-        features = [
-            self.patch_maker.patchify(x, return_spatial_info=True) for x in features
+        With an active feature cache the embeddings are computed once and
+        served from the cache afterwards, without decoding any image. The
+        cache is bypassed if the backbone is trained or the dataset applies
+        random augmentation, as the embeddings then change between epochs.
+        """
+        dataset = input_data.dataset
+        if (self.feature_cache is None or self.train_backbone
+                or not getattr(dataset, "deterministic", False)):
+            if self.feature_cache is not None:
+                LOGGER.info("Features are not deterministic, bypassing the feature cache.")
+            for data_item in input_data:
+                img = data_item["image"].to(torch.float).to(self.device)
+                yield self._embed(img, evaluation=False)[0]
+            return
+
+        keys = [
+            self.feature_cache.key(x[2], dataset.transform_key)
+            for x in dataset.data_to_iterate
         ]
-   
-        patch_shapes = [x[1] for x in features]
-        features = [x[0] for x in features]
-        ref_num_patches = patch_shapes[0]
-
-        for i in range(1, len(features)):
-            _features = features[i]
-            patch_dims = patch_shapes[i]
-
-            # TODO(pgehler): Add comments
-            _features = _features.reshape(
-                _features.shape[0], patch_dims[0], patch_dims[1], *_features.shape[2:]
-            )
-           
-            _features = _features.permute(0, -3, -2, -1, 1, 2)
-            
-            perm_base_shape = _features.shape
-            _features = _features.reshape(-1, *_features.shape[-2:])
-           
-            _features = F.interpolate(
-                _features.unsqueeze(1),
-                size=(ref_num_patches[0], ref_num_patches[1]),
-                mode="bilinear",
-                align_corners=False,
-            )
-            _features = _features.squeeze(1)
-            _features = _features.reshape(
-                *perm_base_shape[:-2], ref_num_patches[0], ref_num_patches[1]
-            )
-            _features = _features.permute(0, -2, -1, 1, 2, 3)
-            _features = _features.reshape(len(_features), -1, *_features.shape[-3:])
-            features[i] = _features
-            
-        features = [x.reshape(-1, *x.shape[-3:]) for x in features]
-      
-        # As different feature backbones & patching provide differently
-        # sized features, these are brought into the correct form here.
-        features = self.forward_modules["preprocessing"](features) # pooling each feature to same channel and stack together
-        features = self.forward_modules["preadapt_aggregator"](features) # further pooling   
+        if all(key in self.feature_cache for key in keys):
+            order = torch.randperm(len(keys)).tolist()
+            for i in range(0, len(order), input_data.batch_size):
+                yield torch.cat([
+                    self.feature_cache.get(keys[idx])
+                    for idx in order[i:i + input_data.batch_size]
+                ]).to(self.device)
+            return
 
-
-        return features, patch_shapes
+        for data_item in input_data:
+            img = data_item["image"].to(torch.float).to(self.device)
+            features = self._embed(img, evaluation=False)[0]
+            batch_keys = [
+                self.feature_cache.key(path, dataset.transform_key)
+                for path in data_item["image_path"]
+            ]
+            for key, image_features in zip(batch_keys, features.chunk(len(batch_keys))):
+                self.feature_cache.put(key, image_features)
+            yield features
     
 
     #############################domain adaptation 을 위한 embed 진행(target size 에 맞춰주는 과정 X)##################
@@ -383,80 +598,7 @@ class SimpleNet(torch.nn.Module):
 
     def domainadapt_embed(self, images, detach=True, provide_patch_shapes=False, evaluation=False):
         """Returns feature embeddings for images."""
-
-
-        B = len(images) #배치 크기를 B변수에 저장함 
-        if not evaluation and self.train_backbone:
-            self.forward_modules["feature_aggregator"].train() #feature_aggregator를 train모드로 설정
-            features = self.forward_modules["feature_aggregator"](images, eval=evaluation)
-        else:
-            _ = self.forward_modules["feature_aggregator"].eval()
-            with torch.no_grad():
-                features = self.forward_modules["feature_aggregator"](images) #이미지들에 대한 feature계산 
-
-        features = [features[layer] for layer in self.layers_to_extract_from] #특정 layer에서 추출한 feature설정 
-    
-
-        for i, feat in enumerate(features):
-            if len(feat.shape) == 3: #피처가 3차원인 경우
-                B, L, C = feat.shape #배치 크기, 길이, 채널 수를 저장 
-                features[i] = feat.reshape(B, int(math.sqrt(L)), int(math.sqrt(L)), C).permute(0, 3, 1, 2) 
-                #3D 텐서에서 4D 텐서로 저장 
-
-        features = [
-            self.patch_maker.patchify(x, return_spatial_info=True) for x in features
-        ]
- 
-        patch_shapes = [x[1] for x in features]
-        features = [x[0] for x in features]
-        ref_num_patches = patch_shapes[0]
-
-        for i in range(1, len(features)):
-            _features = features[i]
-            patch_dims = patch_shapes[i]
-
-            # TODO(pgehler): Add comments
-            _features = _features.reshape(
-                _features.shape[0], patch_dims[0], patch_dims[1], *_features.shape[2:]
-            )
-
-            _features = _features.permute(0, -3, -2, -1, 1, 2)
-
-            perm_base_shape = _features.shape
-            _features = _features.reshape(-1, *_features.shape[-2:])
- 
-            _features = F.interpolate(
-                _features.unsqueeze(1),
-                size=(ref_num_patches[0], ref_num_patches[1]),
-                mode="bilinear",
-                align_corners=False,
-            )
-            _features = _features.squeeze(1)
-            _features = _features.reshape(
-                *perm_base_shape[:-2], ref_num_patches[0], ref_num_patches[1]
-            )
-            _features = _features.permute(0, -2, -1, 1, 2, 3)
-            _features = _features.reshape(len(_features), -1, *_features.shape[-3:])
-
-            features[i] = _features
-
-        
-        features = [x.reshape(-1, *x.shape[-3:]) for x in features] #피처를 2D로 변환 
-        #features = [x.reshape(x.shape[0], x.shape[1], -1) for x in features]
-
-        #features = [x.reshape(x.shape[0], -1) for x in features]
-
-        # As different feature backbones & patching provide differently
-        # sized features, these are brought into the correct form here.
-        ##########
-        features = self.forward_modules["preprocessing"](features) # pooling each feature to same channel and stack together
-        #print('aggregator before', features.shape)
-        
-        features = self.forward_modules["preadapt_aggregator"](features) # further pooling   
-        #print('domainadapt_embed', features.shape)   #6728 1536  
-
-
-        return features, patch_shapes
+        return self.embedding_engine(images, evaluation)
 
     
     def test(self, training_data, test_data, save_segmentation_images):
@@ -492,13 +634,15 @@ class SimpleNet(torch.nn.Module):
             
             else:
                 self.load_state_dict(state_dicts, strict=False)
-        
 
-        aggregator = {"scores": [], "segmentations": [], "features": []}
-        scores, segmentations, features, labels_gt, masks_gt = self.predict(test_data)
-        aggregator["scores"].append(scores)
-        aggregator["segmentations"].append(segmentations)
-        aggregator["features"].append(features)
+        if self.quantize_int8:
+            self._use_quantized(training_data)
+
+        evaluation = self.predict(test_data)
+        aggregator = {
+            "scores": [evaluation.scores],
+            "segmentations": [evaluation.segmentations],
+        }
 
         scores = np.array(aggregator["scores"])
         min_scores = scores.min(axis=-1).reshape(-1, 1)
@@ -533,52 +677,53 @@ class SimpleNet(torch.nn.Module):
 
         # Compute PRO score & PW Auroc for all images
         pixel_scores = metrics.compute_pixelwise_retrieval_metrics(
-            segmentations, masks_gt
+            segmentations, evaluation.positive_masks
         )
         full_pixel_auroc = pixel_scores["auroc"]
 
 
         return auroc, full_pixel_auroc , 1
     
-    def _evaluate(self, test_data, scores, segmentations, features, labels_gt, masks_gt):
-        
+    def _pixel_accumulator(self):
+        """Returns a fresh streaming pixel metric accumulator, or None for exact metrics."""
+        if self.pixel_metric_bins > 0:
+            return metrics.PixelMetricAccumulator(self.pixel_metric_bins)
+        return None
+
+    def _evaluate(self, evaluation):
+        """Returns image AUROC, pixel AUROC and PRO of a predict() result."""
 
-        scores = np.squeeze(np.array(scores))
+        scores = evaluation.scores
         img_min_scores = scores.min(axis=-1)
         img_max_scores = scores.max(axis=-1)
         scores = (scores - img_min_scores) / (img_max_scores - img_min_scores)
         # scores = np.mean(scores, axis=0)
 
         auroc = metrics.compute_imagewise_retrieval_metrics(
-            scores, labels_gt 
+            scores, evaluation.labels
         )["auroc"]
 
-        if len(masks_gt) > 0:
-            segmentations = np.array(segmentations)
-            min_scores = (
-                segmentations.reshape(len(segmentations), -1)
-                .min(axis=-1)
-                .reshape(-1, 1, 1, 1)
-            )
-            max_scores = (
-                segmentations.reshape(len(segmentations), -1)
-                .max(axis=-1)
-                .reshape(-1, 1, 1, 1)
+        if evaluation.has_masks:
+            norm_segmentations = metrics.normalize_segmentations(
+                evaluation.segmentations,
+                evaluation.min_scores,
+                evaluation.max_scores,
+                self.seg_normalization,
             )
-            norm_segmentations = np.zeros_like(segmentations)
-            for min_score, max_score in zip(min_scores, max_scores):
-                norm_segmentations += (segmentations - min_score) / max(max_score - min_score, 1e-2)
-            norm_segmentations = norm_segmentations / len(scores)
-
 
             # Compute PRO score & PW Auroc for all images
-            pixel_scores = metrics.compute_pixelwise_retrieval_metrics(
-                norm_segmentations, masks_gt)
-                # segmentations, masks_gt
+            if evaluation.pixel_accumulator is not None and self.seg_normalization != "per_image":
+                # AUROC is invariant to an affine normalization of the whole
+                # stack, so the raw segmentations the accumulator has seen
+                # give the same value.
+                pixel_scores = evaluation.pixel_accumulator.compute()
+            else:
+                pixel_scores = metrics.compute_pixelwise_retrieval_metrics(
+                    norm_segmentations, evaluation.positive_masks)
+                    # segmentations, masks_gt
             full_pixel_auroc = pixel_scores["auroc"]
 
-            pro = metrics.compute_pro(np.squeeze(np.array(masks_gt)), 
-                                            norm_segmentations)
+            pro = metrics.compute_pro(evaluation.masks, norm_segmentations)
         else:
             full_pixel_auroc = -1 
             pro = -1
@@ -601,55 +746,154 @@ class SimpleNet(torch.nn.Module):
 
             self.predict(training_data, "train_")
 
-            scores, segmentations, features, labels_gt, masks_gt = self.predict(test_data)
-            auroc, full_pixel_auroc, anomaly_pixel_auroc = self._evaluate(test_data, scores, segmentations, features, labels_gt, masks_gt)
+            evaluation = self.predict(test_data)
+            auroc, full_pixel_auroc, anomaly_pixel_auroc = self._evaluate(evaluation)
             
             return auroc, full_pixel_auroc, anomaly_pixel_auroc
         
         def update_state_dict(d):
             
+            # Copies, as the snapshot is written while training goes on.
             state_dict["discriminator"] = OrderedDict({
-                k:v.detach().cpu()  #그래디언트를 분리하고 
+                k:v.detach().to("cpu", copy=True)  #그래디언트를 분리하고 
                 for k, v in self.discriminator.state_dict().items()}) #각각을 딕셔너리에 저장 
             if self.pre_proj > 0:
                 state_dict["pre_projection"] = OrderedDict({
-                    k:v.detach().cpu() 
+                    k:v.detach().to("cpu", copy=True) 
                     for k, v in self.pre_projection.state_dict().items()})
+            checkpoint_writer.snapshot(dict(state_dict), i_mepoch, is_best=True)
 
+        checkpoint_writer = CheckpointWriter(self.ckpt_dir, keep_last=self.ckpt_keep_last)
+        early_stopping = EarlyStopping(self.patience)
         best_record = None
-        for i_mepoch in range(self.meta_epochs):
-
-            self._train_discriminator(training_data)
-
-            # torch.cuda.empty_cache()
-            scores, segmentations, features, labels_gt, masks_gt = self.predict(test_data)
-            auroc, full_pixel_auroc, pro = self._evaluate(test_data, scores, segmentations, features, labels_gt, masks_gt)
-            self.logger.logger.add_scalar("i-auroc", auroc, i_mepoch)
-            self.logger.logger.add_scalar("p-auroc", full_pixel_auroc, i_mepoch)
-            self.logger.logger.add_scalar("pro", pro, i_mepoch)
-
-            if best_record is None:
-                best_record = [auroc, full_pixel_auroc, pro]
-                update_state_dict(state_dict)
-                # state_dict = OrderedDict({k:v.detach().cpu() for k, v in self.state_dict().items()})
-            else:
-                if auroc > best_record[0]:
-                    best_record = [auroc, full_pixel_auroc, pro]
-                    update_state_dict(state_dict)
-                    # state_dict = OrderedDict({k:v.detach().cpu() for k, v in self.state_dict().items()})
-                elif auroc == best_record[0] and full_pixel_auroc > best_record[1]:
-                    best_record[1] = full_pixel_auroc
-                    best_record[2] = pro 
-                    update_state_dict(state_dict)
-                    # state_dict = OrderedDict({k:v.detach().cpu() for k, v in self.state_dict().items()})
-
-            print(f"----- {i_mepoch} I-AUROC:{round(auroc, 4)}(MAX:{round(best_record[0], 4)})"
-                  f"  P-AUROC{round(full_pixel_auroc, 4)}(MAX:{round(best_record[1], 4)}) -----"
-                  f"  PRO-AUROC{round(pro, 4)}(MAX:{round(best_record[2], 4)}) -----")
-        
-        torch.save(state_dict, ckpt_path)
+        start_mepoch = 0
+        train_state_path = os.path.join(self.ckpt_dir, "train_state.pth")
+        if self.resume and os.path.exists(train_state_path):
+            train_state = torch.load(train_state_path, map_location="cpu")
+            start_mepoch, best_record, state_dict = self._restore_training_state(train_state)
+            early_stopping.load_state_dict(train_state["early_stopping"])
+            LOGGER.info("Resuming training after meta epoch {}.".format(start_mepoch - 1))
+        try:
+            for i_mepoch in range(start_mepoch, self.meta_epochs):
+
+                self._train_discriminator(training_data)
+
+                stop = False
+                if (i_mepoch + 1) % self.eval_every == 0 or i_mepoch == self.meta_epochs - 1:
+                    # torch.cuda.empty_cache()
+                    # Image AUROC decides the best epoch, so pixel metrics
+                    # and PRO are only computed for candidates.
+                    patch_batches = []
+                    evaluation = self._predict_dataloader(test_data, "", True, patch_batches)
+                    auroc, full_pixel_auroc, pro = self._evaluate(evaluation)
+                    if best_record is None or auroc >= best_record[0]:
+                        # Segmentations of candidates are built from the
+                        # patch scores of the first pass.
+                        evaluation = self._segment_patch_batches(patch_batches, evaluation.count)
+                        auroc, full_pixel_auroc, pro = self._evaluate(evaluation)
+                        self.logger.add_scalar("p-auroc", full_pixel_auroc, i_mepoch)
+                        self.logger.add_scalar("pro", pro, i_mepoch)
+                    self.logger.add_scalar("i-auroc", auroc, i_mepoch)
+
+                    improved = True
+                    if best_record is None:
+                        best_record = [auroc, full_pixel_auroc, pro]
+                        update_state_dict(state_dict)
+                        # state_dict = OrderedDict({k:v.detach().cpu() for k, v in self.state_dict().items()})
+                    else:
+                        if auroc > best_record[0]:
+                            best_record = [auroc, full_pixel_auroc, pro]
+                            update_state_dict(state_dict)
+                            # state_dict = OrderedDict({k:v.detach().cpu() for k, v in self.state_dict().items()})
+                        elif auroc == best_record[0] and full_pixel_auroc > best_record[1]:
+                            best_record[1] = full_pixel_auroc
+                            best_record[2] = pro 
+                            update_state_dict(state_dict)
+                            # state_dict = OrderedDict({k:v.detach().cpu() for k, v in self.state_dict().items()})
+                        else:
+                            improved = False
+                    stop = early_stopping.step(improved)
+
+                    print(f"----- {i_mepoch} I-AUROC:{round(auroc, 4)}(MAX:{round(best_record[0], 4)})"
+                          f"  P-AUROC{round(full_pixel_auroc, 4)}(MAX:{round(best_record[1], 4)}) -----"
+                          f"  PRO-AUROC{round(pro, 4)}(MAX:{round(best_record[2], 4)}) -----")
+                checkpoint_writer.save(
+                    self._training_state(i_mepoch, best_record, state_dict, early_stopping),
+                    "train_state.pth",
+                )
+                if stop:
+                    LOGGER.info("Early stopping after meta epoch {}, no improvement in {} evaluations.".format(
+                        i_mepoch, early_stopping.stale_evaluations))
+                    break
+            
+            checkpoint_writer.save(state_dict, "ckpt.pth")
+        except BaseException:
+            # A failing writer must not hide the exception of the training loop.
+            checkpoint_writer.close(raise_errors=False)
+            raise
+        finally:
+            # Releases the cached embeddings and removes their spill files.
+            if self.feature_cache is not None:
+                self.feature_cache.clear()
+        checkpoint_writer.close()
         
         return best_record
+
+    def _resumable_parts(self):
+        """Returns the trained modules and their optimizers by name."""
+        modules = {"discriminator": self.discriminator}
+        optimizers = {"dsc_opt": self.dsc_opt}
+        if self.pre_proj > 0:
+            modules["pre_projection"] = self.pre_projection
+            optimizers["proj_opt"] = self.proj_opt
+        if self.train_backbone:
+            modules["backbone"] = self.forward_modules["feature_aggregator"].backbone
+            optimizers["backbone_opt"] = self.backbone_opt
+        return modules, optimizers
+
+    def _training_state(self, i_mepoch, best_record, state_dict, early_stopping):
+        """Returns a CPU copy of everything needed to continue after i_mepoch."""
+        modules, optimizers = self._resumable_parts()
+        np_state = np.random.get_state()
+        return _cpu_copy({
+            "meta_epoch": i_mepoch + 1,
+            "best_record": best_record,
+            "best_state_dict": state_dict,
+            "modules": {name: module.state_dict() for name, module in modules.items()},
+            "optimizers": {name: opt.state_dict() for name, opt in optimizers.items()},
+            "dsc_schl": self.dsc_schl.state_dict(),
+            "g_iter": self.logger.g_iter,
+            "early_stopping": early_stopping.state_dict(),
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+                # Stored as tensors so that the file only holds plain types.
+                "numpy": [np_state[0], torch.from_numpy(np_state[1].astype(np.int64))] + list(np_state[2:]),
+                "random": random.getstate(),
+                "noise": self.noise_generator.get_state(),
+            },
+        })
+
+    def _restore_training_state(self, train_state):
+        """Loads a _training_state() and returns (next meta epoch, best_record, best state_dict)."""
+        modules, optimizers = self._resumable_parts()
+        for name, module in modules.items():
+            module.load_state_dict(train_state["modules"][name])
+        for name, opt in optimizers.items():
+            opt.load_state_dict(train_state["optimizers"][name])
+        self.dsc_schl.load_state_dict(train_state["dsc_schl"])
+        self.logger.g_iter = train_state["g_iter"]
+
+        rng = train_state["rng"]
+        torch.set_rng_state(rng["torch"])
+        if torch.cuda.is_available() and len(rng["cuda"]) == torch.cuda.device_count():
+            torch.cuda.set_rng_state_all(rng["cuda"])
+        np_state = rng["numpy"]
+        np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32), *np_state[2:]))
+        random.setstate(rng["random"])
+        self.noise_generator.set_state(rng.get("noise"))
+        return train_state["meta_epoch"], train_state["best_record"], dict(train_state["best_state_dict"])
+
     #################################################domain classifier 정의##############################################################
 
     criterion = nn.CrossEntropyLoss()
@@ -660,133 +904,188 @@ class SimpleNet(torch.nn.Module):
 
         return state_dict
 
-    def _train_discriminator(self, input_data):
-        """Computes and sets the support features for SPADE."""
-
-
-        tgt_dir = '/home/smk/data/project/MVTec'
-        src_dir = '/home/smk/data/dataset/imagenet-sample-images-master'
-        #src_dir = '/home/smk/data/project/MVTec_noclass_carpet/carpet/train'
-        
-
-        src_data = CustomImageDataset(root_dir=os.path.join(src_dir),
-                                    transform=transforms.Compose([
-                                        transforms.Resize(256),
-                                        transforms.RandomCrop(227),
-                                        transforms.ToTensor(),
-                                    ]))
-        
-        src_data_tensor = torch.stack([torch.tensor(sample) for sample in src_data])
-        src_data = src_data_tensor.to(torch.float).to(self.device)
-        
-
-        for data_item in input_data:
+    @staticmethod
+    def _ordered_loader(dataloader):
+        """Returns an unshuffled copy of dataloader with the same loading setup."""
+        return torch.utils.data.DataLoader(
+            dataloader.dataset,
+            batch_size=dataloader.batch_size,
+            shuffle=False,
+            num_workers=dataloader.num_workers,
+            prefetch_factor=dataloader.prefetch_factor,
+            pin_memory=dataloader.pin_memory,
+        )
 
-            tgt_data = data_item["image"]
-            tgt_data = tgt_data.to(torch.float).to(self.device)
+    def _domain_features(self, dataloader, n_views=1):
+        """Embeds every image of dataloader n_views times.
 
+        Returns a float16 tensor of shape [n_images, n_views, n_patches, dim]
+        on the cpu, filled in place batch by batch. The views differ only if
+        the loader applies random transforms.
+        """
+        features = None
+        for view in range(n_views):
+            start = 0
+            for batch in self._stream_domain_features(dataloader, per_image=True):
+                if features is None:
+                    features = torch.empty(
+                        (len(dataloader.dataset), n_views) + tuple(batch.shape[1:]), dtype=torch.float16
+                    )
+                features[start:start + len(batch), view] = batch
+                start += len(batch)
+        return features
+
+    def _stream_domain_features(self, dataloader, per_image=False):
+        """Yields the detached embeddings of every batch of dataloader."""
+        for data in dataloader:
+            image = data["image"] if isinstance(data, dict) else data
+            image = image.to(torch.float).to(self.device, non_blocking=True)
+            with torch.no_grad():
+                features, patch_shapes = self.domainadapt_embed(image, evaluation=False)
+            if per_image:
+                n_patches = patch_shapes[0][0] * patch_shapes[0][1]
+                features = features.reshape(len(image), n_patches, -1)
+            yield features
+
+    def train_domain_classifier(self, input_data, source_data, epochs=600, lr=1e-3,
+                                momentum=0.9, lam=0.01, views=0, batch_size=8):
+        """Trains a domain classifier to separate source from target embeddings.
+
+        By default (views == 0) both domains are streamed from their loaders
+        every epoch, which keeps memory independent of their size. The
+        classifier only consumes detached features, so with views > 0 both
+        domains are instead embedded once up front and each epoch draws one
+        of the views cached random-crop views per image instead of
+        re-running the backbone. The cache is float16 and costs
+        n_patches * dim * 2 bytes per image and view, about 4 MB for
+        wideresnet50 layer2+layer3 at 288px.
+        """
+        if views > 0:
+            LOGGER.info("Embedding source and target domain...")
+            src_features = self._domain_features(self._ordered_loader(source_data), views)
+            tgt_views = 1 if getattr(input_data.dataset, "deterministic", False) else views
+            tgt_features = self._domain_features(self._ordered_loader(input_data), tgt_views)
+
+            def sample_batches(features):
+                # One random view per image, images in random order.
+                order = torch.randperm(len(features))
+                views = torch.randint(0, features.shape[1], (len(features),))
+                for i in range(0, len(features), batch_size):
+                    idxs = order[i:i + batch_size]
+                    yield features[idxs, views[idxs]].reshape(-1, features.shape[-1]).to(self.device).float()
+
+            src_batches = lambda: sample_batches(src_features)
+            tgt_batches = lambda: sample_batches(tgt_features)
+        else:
+            src_batches = lambda: self._stream_domain_features(source_data)
+            tgt_batches = lambda: self._stream_domain_features(input_data)
 
-        # tgt_data = datasets.ImageFolder(os.path.join(tgt_dir),
-        #                                     transform=transforms.Compose([
-        #                                             transforms.Resize(256),
-        #                                             transforms.RandomCrop(227),
-        #                                             transforms.ToTensor(),
-        #                                     ]))
-        
-        src_train_loader = torch.utils.data.DataLoader(src_data, batch_size=8, shuffle=True)
-        tgt_train_loader = torch.utils.data.DataLoader(tgt_data, batch_size=8, shuffle=True)
- 
         dm_classifier = DomainClassifier().to(self.device)
-        lam =  0.01
-        momentum = 0.9
-        lr = 1e-3
         criterion = nn.CrossEntropyLoss().to(self.device)
-        epochs = 600
         optimizer_dm = optim.SGD( #fcD 학습할 때 사용하는 옵티마이저 정의 
             dm_classifier.parameters(),
             lr=lr,
             momentum=momentum) 
-        
 
         dm_classifier.train()
 
-
-        # 텐서보드 로거 생성 및 로그 디렉토리 지정
-        
-        #log_dir = "/home/smk/data/project/SimpleNetrevised_copy/domainresults"
-        #writer = SummaryWriter(log_dir=log_dir)
-
-
-        with tqdm.tqdm(total=self.gan_epochs) as pbar:
+        with tqdm.tqdm(total=epochs) as pbar:
             for i_epoch in range(1, epochs+1):
-                #print('domain adaptation 시작 !!!')
-                for src_data, tgt_data  in zip(src_train_loader, tgt_train_loader):
-
-                    optimizer_dm.zero_grad()
-
-                    
-                    # src_label_dm = torch.ones(tgt_data[1].shape[0]).to("cuda").long()
-                    # tgt_label_dm = torch.zeros(tgt_data[1].shape[0]).to("cuda").long()
-
-                    #cuda 오류 뜨는 코드
-                    # src_label_dm = torch.ones(tgt_data.shape[0]).to(self.device).long()
-                    # tgt_label_dm = torch.zeros(tgt_data.shape[0]).to(self.device).long()
-
-
-                    #print("src", src_data.shape)
-                    #print(src_label_dm)
-                    #print(tgt_label_dm)
-
-                    
-                    src_feature, _ = self.domainadapt_embed(src_data.to(self.device), evaluation=False)
-                    tgt_feature, _ = self.domainadapt_embed(tgt_data.to(self.device), evaluation=False)
-
+                for src_feature, tgt_feature in zip(src_batches(), tgt_batches()):
                     src_label_dm = torch.ones(src_feature.shape[0]).to(self.device).long()
                     tgt_label_dm = torch.zeros(tgt_feature.shape[0]).to(self.device).long()
-                    #print('src_feature', src_feature.shape)
-                    #print('tgt_feature', tgt_feature.shape)
-                
+
                     optimizer_dm.zero_grad()
                     # domain output
+                    src_output_dm = dm_classifier(src_feature)
+                    tgt_output_dm = dm_classifier(tgt_feature)
 
-                    src_output_dm = dm_classifier(src_feature.detach())
-                    #print('src_output', src_output_dm.shape)
-                    #print('src_label_dm', src_label_dm.shape)
-                    #print('tgt_label_dm', tgt_label_dm.shape)
-                    tgt_output_dm = dm_classifier(tgt_feature.detach())
-                    #print('tgt_output', tgt_output_dm.shape)
-
-                    src_data, src_label_dm = src_data.to(self.device), src_label_dm.to(self.device)
-                    tgt_data, tgt_label_dm = tgt_data.to(self.device), tgt_label_dm.to(self.device)
                     loss_dm_src = criterion(src_output_dm, src_label_dm)
                     loss_dm_tgt = criterion(tgt_output_dm, tgt_label_dm)
                     loss_dm = lam * (loss_dm_src + loss_dm_tgt)
                     loss_dm.backward()
                     optimizer_dm.step()
 
-                    
                 #######ACC, LOSS PRINT METRIC###########
 
                 acc = acc_fn(tgt_output_dm, tgt_label_dm)
-                acc_tensor = torch.tensor(acc)
-
-                
 
-                #pbar.set_description(f"ACC {acc}")
                 pbar.set_description(f"Epoch {i_epoch}")
-                pbar.set_postfix(loss_dm=loss_dm.item(), acc=acc_tensor.item())
-                #pbar.set_postfix(loss_dm=loss_dm.item())
+                pbar.set_postfix(loss_dm=loss_dm.item(), acc=acc)
                 pbar.update(1)
 
-
                 # 정확도 기록
-                self.ad_logger.logger.add_scalar('Loss', loss_dm.item(), global_step=i_epoch)
-                self.ad_logger.logger.add_scalar('Accuracy', acc, global_step=i_epoch)
-                # writer.add_scalar('Loss', loss_dm.item(), global_step=i_epoch)
-                # writer.add_scalar('Accuracy', acc, global_step=i_epoch)
-    
+                self.ad_logger.add_scalar('Loss', loss_dm.item(), i_epoch)
+                self.ad_logger.add_scalar('Accuracy', acc, i_epoch)
+
+        return dm_classifier
+
+    def _domain_artifact_key(self, input_data, source_data, config):
+        """Hashes everything the trained domain classifier depends on."""
+        def image_files(dataset):
+            paths = getattr(dataset, "image_paths", None)
+            if paths is None:
+                paths = [x[2] for x in dataset.data_to_iterate]
+            return [(path, os.path.getsize(path), os.path.getmtime(path)) for path in paths]
+
+        def weights_file(backbone):
+            # Weights file of backbones.get, None for downloaded weights.
+            path = getattr(backbone, "weights_path", None)
+            return None if path is None else (path, os.path.getsize(path), os.path.getmtime(path))
+
+        description = {
+            "backbone": getattr(self.backbone, "name", type(self.backbone).__name__),
+            "backbone_weights": weights_file(self.backbone),
+            "layers_to_extract_from": list(self.layers_to_extract_from),
+            "input_shape": list(self.input_shape),
+            "patchsize": self.patch_maker.patchsize,
+            "patchstride": self.patch_maker.stride,
+            "pretrain_embed_dimension": self.forward_modules["preprocessing"].output_dim,
+            "target_embed_dimension": self.target_embed_dimension,
+            "config": config,
+            "source": image_files(source_data.dataset),
+            "target": image_files(input_data.dataset),
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def domain_adaptation(self, input_data, source_data, artifact_dir, **config):
+        """Runs domain classifier training once and reuses its artifact.
+
+        The trained classifier is stored in artifact_dir under a hash of the
+        backbone, layers, data and config. If a valid artifact with the same
+        hash exists it is loaded instead of training again.
+        """
+        self.ad_model_dir(artifact_dir, self.dataset_name)
+        key = self._domain_artifact_key(input_data, source_data, config)
+        artifact_path = os.path.join(self.ad_ckpt_dir, "domain_{}.pth".format(key[:16]))
+
+        if os.path.exists(artifact_path):
+            try:
+                artifact = torch.load(artifact_path, map_location=self.device)
+            except Exception as exception:
+                LOGGER.warning(f"Ignoring unreadable domain artifact {artifact_path}: {exception}")
+                artifact = {}
+            if artifact.get("key") == key:
+                LOGGER.info(f"Reusing domain classifier from {artifact_path}.")
+                self.domain_classifier = DomainClassifier().to(self.device)
+                self.domain_classifier.load_state_dict(artifact["domain_classifier"])
+                return artifact_path
+
+        self.domain_classifier = self.train_domain_classifier(input_data, source_data, **config)
+        artifact = {
+            "key": key,
+            "config": config,
+            "domain_classifier": OrderedDict(
+                (k, v.detach().cpu()) for k, v in self.domain_classifier.state_dict().items()
+            ),
+        }
+        torch.save(artifact, artifact_path + ".tmp")
+        os.replace(artifact_path + ".tmp", artifact_path)
+        return artifact_path
+
+    def _train_discriminator(self, input_data):
+        """Computes and sets the support features for SPADE."""
 
-        self.save_classifier_weights(dm_classifier, "/home/smk/data/project/SimpleNetrevised/domainresults/domainresults.pth")
 
 
         _ = self.forward_modules.eval()
@@ -798,14 +1097,15 @@ class SimpleNet(torch.nn.Module):
         # self.feature_dec.eval()
         i_iter = 0
         LOGGER.info(f"Training discriminator...")
+        metrics_buffer = MetricsBuffer(
+            ["p_true", "p_fake", "loss"], self.device,
+            self.logger if self.tensorboard else None, self.log_every,
+        )
         with tqdm.tqdm(total=self.gan_epochs) as pbar:
             for i_epoch in range(self.gan_epochs):
-                all_loss = []
-                all_p_true = []
-                all_p_fake = []
                 all_p_interp = []
                 embeddings_list = []
-                for data_item in input_data:
+                for embeddings in self._training_features(input_data):
                     self.dsc_opt.zero_grad()
                     if self.pre_proj > 0:
                         self.proj_opt.zero_grad()
@@ -815,24 +1115,15 @@ class SimpleNet(torch.nn.Module):
                     ##학습한 img 가져오기
                     
                     #print(img_da.shape) #[10368,2]
-                    img = data_item["image"]
-                    img = img.to(torch.float).to(self.device)
-                    #print(img.shape) #[8,3,288,288]
                     if self.pre_proj > 0:
-                        true_feats = self.pre_projection(self._embed(img, evaluation=False)[0])
+                        true_feats = self.pre_projection(embeddings)
                         
                     else:
-                        true_feats = self._embed(img, evaluation=False)[0] #original : 10368, 1536]
+                        true_feats = embeddings #original : 10368, 1536]
                         
                     
                     #print(true_feats.shape) #[10368,1536]
-                    noise_idxs = torch.randint(0, self.mix_noise, torch.Size([true_feats.shape[0]]))
-                    noise_one_hot = torch.nn.functional.one_hot(noise_idxs, num_classes=self.mix_noise).to(self.device) # (N, K)
-                    noise = torch.stack([
-                        torch.normal(0, self.noise_std * 1.1**(k), true_feats.shape)
-                        for k in range(self.mix_noise)], dim=1).to(self.device) # (N, K, C)
-                    noise = (noise * noise_one_hot.unsqueeze(-1)).sum(1)
-                    fake_feats = true_feats + noise
+                    fake_feats = true_feats + self.noise_generator(true_feats.shape, true_feats.dtype)
 
                     #print(true_feats.shape, fake_feats.shape)
 
@@ -851,11 +1142,8 @@ class SimpleNet(torch.nn.Module):
                     true_loss = torch.clip(-true_scores + th, min=0)
                     fake_loss = torch.clip(fake_scores + th, min=0)
 
-                    self.logger.logger.add_scalar(f"p_true", p_true, self.logger.g_iter)
-                    self.logger.logger.add_scalar(f"p_fake", p_fake, self.logger.g_iter)
-
                     loss = true_loss.mean() + fake_loss.mean()
-                    self.logger.logger.add_scalar("loss", loss, self.logger.g_iter)
+                    metrics_buffer.log(self.logger.g_iter, p_true, p_fake, loss)
                     self.logger.step()
 
                     loss.backward()
@@ -864,11 +1152,6 @@ class SimpleNet(torch.nn.Module):
                     if self.train_backbone:
                         self.backbone_opt.step()
                     self.dsc_opt.step()
-
-                    loss = loss.detach().cpu() 
-                    all_loss.append(loss.item())
-                    all_p_true.append(p_true.cpu().item())
-                    all_p_fake.append(p_fake.cpu().item())
                 
                 if len(embeddings_list) > 0:
                     self.auto_noise[1] = torch.cat(embeddings_list).std(0).mean(-1)
@@ -876,9 +1159,10 @@ class SimpleNet(torch.nn.Module):
                 if self.cos_lr:
                     self.dsc_schl.step()
                 
-                all_loss = sum(all_loss) / len(input_data)
-                all_p_true = sum(all_p_true) / len(input_data)
-                all_p_fake = sum(all_p_fake) / len(input_data)
+                epoch_means = metrics_buffer.means()
+                all_loss = epoch_means["loss"]
+                all_p_true = epoch_means["p_true"]
+                all_p_fake = epoch_means["p_fake"]
                 cur_lr = self.dsc_opt.state_dict()['param_groups'][0]['lr']
                 pbar_str = f"epoch:{i_epoch} loss:{round(all_loss, 5)} "
                 pbar_str += f"lr:{round(cur_lr, 6)}"
@@ -887,43 +1171,73 @@ class SimpleNet(torch.nn.Module):
                     pbar_str += f" p_interp:{round(sum(all_p_interp) / len(input_data), 3)}"
                 pbar.set_description_str(pbar_str)
                 pbar.update(1)
+        metrics_buffer.close()
 
 
-    def predict(self, data, prefix=""):
+    def predict(self, data, prefix="", image_only=False):
         if isinstance(data, torch.utils.data.DataLoader):
-            return self._predict_dataloader(data, prefix)
-        return self._predict(data)
+            return self._predict_dataloader(data, prefix, image_only)
+        return self._predict(data, return_segmentations=not image_only)
 
-    def _predict_dataloader(self, dataloader, prefix):
-        """This function provides anomaly scores/maps for full dataloaders."""
-        _ = self.forward_modules.eval()
+    def _predict_dataloader(self, dataloader, prefix, image_only=False, patch_batches=None):
+        """This function provides anomaly scores/maps for full dataloaders.
 
+        Returns a metrics.EvaluationAccumulator holding the predictions,
+        only with image scores if image_only is set. If image_only is set
+        and patch_batches is a list, the patch scores and ground truth of
+        every batch are appended to it for _segment_patch_batches.
+        """
+        _ = self.forward_modules.eval()
 
-        img_paths = []
-        scores = []
-        masks = []
-        features = []
-        labels_gt = []
-        masks_gt = []
-        from sklearn.manifold import TSNE
-
+        evaluation = metrics.EvaluationAccumulator(
+            len(dataloader.dataset), self._pixel_accumulator()
+        )
         with tqdm.tqdm(dataloader, desc="Inferring...", leave=False) as data_iterator:
             for data in data_iterator:
-                if isinstance(data, dict):
-                    labels_gt.extend(data["is_anomaly"].numpy().tolist())
-                    if data.get("mask", None) is not None:
-                        masks_gt.extend(data["mask"].numpy().tolist())
-                    image = data["image"]
-                    img_paths.extend(data['image_path'])
-                _scores, _masks, _feats = self._predict(image)
-                for score, mask, feat, is_anomaly in zip(_scores, _masks, _feats, data["is_anomaly"].numpy().tolist()):
-                    scores.append(score)
-                    masks.append(mask)
-
-        return scores, masks, features, labels_gt, masks_gt
-
-    def _predict(self, images):
-        """Infer score and mask for a batch of images."""
+                mask = data.get("mask", None)
+                mask = None if mask is None else mask.numpy()
+                if image_only and patch_batches is not None:
+                    _scores, patch_scores, _, _ = self._score_patches(data["image"])
+                    patch_batches.append({
+                        "scores": _scores,
+                        "patch_scores": patch_scores,
+                        "is_anomaly": data["is_anomaly"].numpy(),
+                        # Masks are 8-bit images scaled to [0, 1], see metrics.EvaluationAccumulator.
+                        "mask": None if mask is None else np.rint(mask * 255).astype(np.uint8),
+                        "image_path": data["image_path"],
+                    })
+                    _masks = None
+                else:
+                    _scores, _masks, _feats = self._predict(
+                        data["image"], return_segmentations=not image_only
+                    )
+                evaluation.update(
+                    _scores,
+                    None if image_only else _masks,
+                    data["is_anomaly"].numpy(),
+                    mask,
+                    data["image_path"],
+                )
+
+        return evaluation
+
+    def _segment_patch_batches(self, patch_batches, n_images):
+        """Returns the full EvaluationAccumulator of batches kept by an image_only pass."""
+        evaluation = metrics.EvaluationAccumulator(n_images, self._pixel_accumulator())
+        for batch in patch_batches:
+            segmentations, _ = self.anomaly_segmentor.convert_to_segmentation(batch["patch_scores"])
+            mask = batch["mask"]
+            evaluation.update(
+                batch["scores"],
+                segmentations,
+                batch["is_anomaly"],
+                None if mask is None else mask.astype(np.float32) / 255,
+                batch["image_path"],
+            )
+        return evaluation
+
+    def _score_patches(self, images):
+        """Returns the image scores, the patch score maps, the embeddings and patch shapes of a batch."""
         images = images.to(torch.float).to(self.device)
         _ = self.forward_modules.eval()
 
@@ -931,16 +1245,18 @@ class SimpleNet(torch.nn.Module):
         if self.pre_proj > 0:
             self.pre_projection.eval()
         self.discriminator.eval()
-        with torch.no_grad():
+        # The int8 modules run with the quantized engine they were made for.
+        with torch.no_grad(), common.quantized_engine(self.quantized_engine):
             features, patch_shapes = self._embed(images,
                                                  provide_patch_shapes=True, 
-                                                 evaluation=True)
-            if self.pre_proj > 0:
-                features = self.pre_projection(features)
+                                                 evaluation=True, project=True)
 
             # features = features.cpu().numpy()
             # features = np.ascontiguousarray(features.cpu().numpy())
-            patch_scores = image_scores = -self.discriminator(features)
+            discriminator = self.discriminator
+            if self.quantized_discriminator is not None:
+                discriminator = self.quantized_discriminator
+            patch_scores = image_scores = -discriminator(features)
             patch_scores = patch_scores.cpu().numpy()
             image_scores = image_scores.cpu().numpy()
 
@@ -955,10 +1271,28 @@ class SimpleNet(torch.nn.Module):
             )
             scales = patch_shapes[0]
             patch_scores = patch_scores.reshape(batchsize, scales[0], scales[1])
+        return list(image_scores), patch_scores, features, patch_shapes
+
+    def _predict(self, images, return_features=False, return_segmentations=True):
+        """Infer score and mask for a batch of images.
+
+        Features upsampled to the input resolution are only computed if
+        return_features is set, segmentations only if return_segmentations
+        is set. Empty lists are returned in their place otherwise.
+        """
+        image_scores, patch_scores, features, patch_shapes = self._score_patches(images)
+        if not return_segmentations:
+            return image_scores, [], []
+
+        batchsize = len(image_scores)
+        scales = patch_shapes[0]
+        if return_features:
             features = features.reshape(batchsize, scales[0], scales[1], -1)
-            masks, features = self.anomaly_segmentor.convert_to_segmentation(patch_scores, features)
+        else:
+            features = None
+        masks, features = self.anomaly_segmentor.convert_to_segmentation(patch_scores, features)
 
-        return list(image_scores), list(masks), list(features)
+        return image_scores, list(masks), list(features)
 
     @staticmethod
     def _params_file(filepath, prepend=""):
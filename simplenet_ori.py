@@ -218,6 +218,18 @@ class SimpleNet(torch.nn.Module):
 
         self.forward_modules["preadapt_aggregator"] = preadapt_aggregator
 
+        self.embedding_engine = common.EmbeddingEngine(
+            feature_aggregator, self.layers_to_extract_from,
+            common.UnfoldPatchStages(self.patch_maker, preprocessing, preadapt_aggregator),
+            train_backbone=train_backbone,
+        )
+        # Domain adaptation pools all patches of an image into one embedding.
+        self.domainadapt_engine = common.EmbeddingEngine(
+            feature_aggregator, self.layers_to_extract_from,
+            common.UnfoldPatchStages(self.patch_maker, preprocessing, preadapt_aggregator, per_image=True),
+            train_backbone=train_backbone,
+        )
+
         self.anomaly_segmentor = common.RescaleSegmentor(
             device=self.device, target_size=input_shape[-2:]
         )
@@ -283,72 +295,7 @@ class SimpleNet(torch.nn.Module):
 
     def _embed(self, images, detach=True, provide_patch_shapes=False, evaluation=False):
         """Returns feature embeddings for images."""
-
-        print('embed 중 !!')
-
-        B = len(images)
-        if not evaluation and self.train_backbone:
-            self.forward_modules["feature_aggregator"].train() #여기서 피처값 뽑히고 학습 진행 (프리트레인된 모델로)
-            features = self.forward_modules["feature_aggregator"](images, eval=evaluation)
-        else:
-            _ = self.forward_modules["feature_aggregator"].eval()
-            with torch.no_grad():
-                features = self.forward_modules["feature_aggregator"](images)
-
-        features = [features[layer] for layer in self.layers_to_extract_from]
-        #print('1', features.shape)
-
-        for i, feat in enumerate(features):
-            if len(feat.shape) == 3:
-                B, L, C = feat.shape
-                features[i] = feat.reshape(B, int(math.sqrt(L)), int(math.sqrt(L)), C).permute(0, 3, 1, 2)
-
-        features = [
-            self.patch_maker.patchify(x, return_spatial_info=True) for x in features
-        ]
-        #print('2', features.shape)
-        patch_shapes = [x[1] for x in features]
-        features = [x[0] for x in features]
-        ref_num_patches = patch_shapes[0]
-
-        for i in range(1, len(features)):
-            _features = features[i]
-            patch_dims = patch_shapes[i]
-
-            # TODO(pgehler): Add comments
-            _features = _features.reshape(
-                _features.shape[0], patch_dims[0], patch_dims[1], *_features.shape[2:]
-            )
-           
-            _features = _features.permute(0, -3, -2, -1, 1, 2)
-            
-            perm_base_shape = _features.shape
-            _features = _features.reshape(-1, *_features.shape[-2:])
-           
-            _features = F.interpolate(
-                _features.unsqueeze(1),
-                size=(ref_num_patches[0], ref_num_patches[1]),
-                mode="bilinear",
-                align_corners=False,
-            )
-            _features = _features.squeeze(1)
-            _features = _features.reshape(
-                *perm_base_shape[:-2], ref_num_patches[0], ref_num_patches[1]
-            )
-            _features = _features.permute(0, -2, -1, 1, 2, 3)
-            _features = _features.reshape(len(_features), -1, *_features.shape[-3:])
-            features[i] = _features
-            
-        features = [x.reshape(-1, *x.shape[-3:]) for x in features]
-      
-        # As different feature backbones & patching provide differently
-        # sized features, these are brought into the correct form here.
-        features = self.forward_modules["preprocessing"](features) # pooling each feature to same channel and stack together
-        features = self.forward_modules["preadapt_aggregator"](features) # further pooling   
-        print('embed', features.shape)     
-
-
-        return features, patch_shapes
+        return self.embedding_engine(images, evaluation)
     
 
     #############################domain adaptation 을 위한 embed 진행(target size 에 맞춰주는 과정 X)##################
@@ -368,77 +315,8 @@ class SimpleNet(torch.nn.Module):
         return self.domainadapt_embed(data)
 
     def domainadapt_embed(self, images, detach=True, provide_patch_shapes=False, evaluation=False):
-        """Returns feature embeddings for images."""
-
-        print('domain adaptation embed 중 !!')
-
-        B = len(images)
-        if not evaluation and self.train_backbone:
-            self.forward_modules["feature_aggregator"].train()
-            features = self.forward_modules["feature_aggregator"](images, eval=evaluation)
-        else:
-            _ = self.forward_modules["feature_aggregator"].eval()
-            with torch.no_grad():
-                features = self.forward_modules["feature_aggregator"](images)
-
-        features = [features[layer] for layer in self.layers_to_extract_from]
-        #print('1', features.shape)
-
-        for i, feat in enumerate(features):
-            if len(feat.shape) == 3:
-                B, L, C = feat.shape
-                features[i] = feat.reshape(B, int(math.sqrt(L)), int(math.sqrt(L)), C).permute(0, 3, 1, 2)
-
-        features = [
-            self.patch_maker.patchify(x, return_spatial_info=True) for x in features
-        ]
-        #print('2', features.shape)
-        patch_shapes = [x[1] for x in features]
-        features = [x[0] for x in features]
-        ref_num_patches = patch_shapes[0]
-
-        for i in range(1, len(features)):
-            _features = features[i]
-            patch_dims = patch_shapes[i]
-
-            # TODO(pgehler): Add comments
-            _features = _features.reshape(
-                _features.shape[0], patch_dims[0], patch_dims[1], *_features.shape[2:]
-            )
-            print('3', len(features[0]))
-            _features = _features.permute(0, -3, -2, -1, 1, 2)
-            print('4', len(features[0]))
-            perm_base_shape = _features.shape
-            _features = _features.reshape(-1, *_features.shape[-2:])
-            print('5', len(features[0]))
-            _features = F.interpolate(
-                _features.unsqueeze(1),
-                size=(ref_num_patches[0], ref_num_patches[1]),
-                mode="bilinear",
-                align_corners=False,
-            )
-            _features = _features.squeeze(1)
-            _features = _features.reshape(
-                *perm_base_shape[:-2], ref_num_patches[0], ref_num_patches[1]
-            )
-            _features = _features.permute(0, -2, -1, 1, 2, 3)
-            _features = _features.reshape(len(_features), -1, *_features.shape[-3:])
-            print(_features.shape)
-            features[i] = _features
-            print('6', len(features[0]), len(features[1]))
-        
-        #features = [x.reshape(-1, *x.shape[-3:]) for x in features]
-        features = [x.reshape(x.shape[0], -1) for x in features]
-        print('7', len(features[0]), len(features[1])) #here 6728
-        # As different feature backbones & patching provide differently
-        # sized features, these are brought into the correct form here.
-        features = self.forward_modules["preprocessing"](features) # pooling each feature to same channel and stack together
-        print('aggregator before', features.shape)
-        features = self.forward_modules["preadapt_aggregator"](features) # further pooling   
-        print('domainadapt_embed', features.shape)   #6728 1536  
-
-
-        return features, patch_shapes
+        """Returns one feature embedding per image."""
+        return self.domainadapt_engine(images, evaluation)
 
     
     def test(self, training_data, test_data, save_segmentation_images):
@@ -0,0 +1,45 @@
+import pytest
+import torch
+import torchvision
+
+import backbones
+
+
+@pytest.fixture(autouse=True)
+def empty_registry(monkeypatch):
+    monkeypatch.setattr(backbones, "_LOADED", {})
+
+
+def test_get_loads_a_backbone_per_weights_file(tmp_path):
+    store = backbones.WeightStore(str(tmp_path / "store"))
+    store.add("resnet18", torchvision.models.resnet18().state_dict())
+    other_path = str(tmp_path / "other.pth")
+    torch.save(torchvision.models.resnet18().state_dict(), other_path)
+
+    from_store = backbones.get("resnet18", weight_store=store.root)
+    from_file = backbones.get("resnet18", weights_path=other_path)
+    assert from_store is not from_file
+    assert from_store is backbones.get("resnet18", weight_store=store.root)
+    assert from_file.weights_path == other_path
+    assert not torch.equal(from_store.conv1.weight, from_file.conv1.weight)
+    with pytest.raises(FileNotFoundError):
+        backbones.get("resnet18", weights_path=str(tmp_path / "missing.pth"))
+
+
+def test_ref_wideresnet50_loads_torchvision_checkpoints(tmp_path):
+    torchvision_model = torchvision.models.wide_resnet50_2()
+    path = str(tmp_path / "wide_resnet50_2.pth")
+    torch.save(torchvision_model.state_dict(), path)
+
+    backbone = backbones.load("ref_wideresnet50", weights_path=path)
+    assert not hasattr(backbone, "fc")
+    assert torch.equal(backbone.layer3[0].conv1.weight, torchvision_model.layer3[0].conv1.weight)
+
+
+def test_weights_files_are_loaded_strictly(tmp_path):
+    state_dict = torchvision.models.resnet18().state_dict()
+    del state_dict["layer2.0.conv1.weight"]
+    path = str(tmp_path / "truncated.pth")
+    torch.save(state_dict, path)
+    with pytest.raises(RuntimeError, match="layer2.0.conv1.weight"):
+        backbones.load("resnet18", weights_path=path)
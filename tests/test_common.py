@@ -0,0 +1,198 @@
+import numpy as np
+import pytest
+import scipy.ndimage as ndimage
+import torch
+
+import common
+
+
+@pytest.mark.parametrize(
+    "height, width",
+    [
+        (288, 288),
+        (37, 37),  # odd
+        (45, 64),  # non-square
+        (64, 23),
+        (9, 12),  # smaller than the kernel radius of 16
+        (1, 5),
+        (3, 40),
+    ],
+)
+def test_gaussian_blur_matches_scipy(height, width):
+    images = np.random.RandomState(height * width).randn(3, height, width)
+    expected = np.stack([ndimage.gaussian_filter(image, sigma=4) for image in images])
+    blurred = common.gaussian_blur(torch.from_numpy(images), sigma=4).numpy()
+    np.testing.assert_allclose(blurred, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_gaussian_blur_matches_scipy_in_float32():
+    images = np.random.RandomState(0).rand(4, 33, 50).astype(np.float32)
+    expected = np.stack([ndimage.gaussian_filter(image, sigma=4) for image in images])
+    blurred = common.gaussian_blur(torch.from_numpy(images), sigma=4)
+    assert blurred.dtype == torch.float32
+    np.testing.assert_allclose(blurred.numpy(), expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("sigma, truncate", [(1.5, 4.0), (4, 2.0)])
+def test_gaussian_blur_matches_scipy_for_other_kernels(sigma, truncate):
+    images = np.random.RandomState(1).randn(2, 21, 30)
+    expected = np.stack(
+        [ndimage.gaussian_filter(image, sigma=sigma, truncate=truncate) for image in images]
+    )
+    blurred = common.gaussian_blur(torch.from_numpy(images), sigma=sigma, truncate=truncate).numpy()
+    np.testing.assert_allclose(blurred, expected, rtol=1e-10, atol=1e-12)
+
+
+@pytest.fixture(scope="module")
+def backbone():
+    import resnet
+
+    torch.manual_seed(0)
+    return resnet.wide_resnet50_2(False).eval()
+
+
+def _embedding_net(backbone, engine, pre_proj, input_shape):
+    import simplenet
+
+    torch.manual_seed(0)
+    net = simplenet.SimpleNet(torch.device("cpu"))
+    net.load(
+        backbone, ["layer2", "layer3"], torch.device("cpu"), input_shape,
+        pretrain_embed_dimension=1536, target_embed_dimension=1536, patchsize=3,
+        pre_proj=pre_proj, embed_engine=engine, tensorboard=False,
+    )
+    return net
+
+
+@pytest.mark.parametrize("engine", ["fused", "linear"])
+@pytest.mark.parametrize("pre_proj", [0, 1])
+@pytest.mark.parametrize("input_shape", [(3, 64, 64), (3, 48, 80)])
+def test_embed_engines_match_unfold(backbone, engine, pre_proj, input_shape):
+    reference_net = _embedding_net(backbone, "unfold", pre_proj, input_shape)
+    net = _embedding_net(backbone, engine, pre_proj, input_shape)
+    if pre_proj:
+        net.pre_projection.load_state_dict(reference_net.pre_projection.state_dict())
+    images = torch.randn(2, *input_shape)
+    for project in [False, True]:
+        with torch.no_grad():
+            reference, reference_shapes = reference_net.embedding_engine(images, evaluation=True, project=project)
+            embeddings, patch_shapes = net.embedding_engine(images, evaluation=True, project=project)
+        assert patch_shapes == reference_shapes
+        assert embeddings.shape == reference.shape
+        scale = max(1.0, reference.abs().max().item())
+        torch.testing.assert_close(embeddings, reference, rtol=0, atol=1e-5 * scale)
+
+
+@pytest.mark.parametrize("engine", ["fused", "linear"])
+def test_embed_engines_match_unfold_while_training(backbone, engine):
+    # Training embeds without the projection and keeps the graph for it.
+    reference_net = _embedding_net(backbone, "unfold", 1, (3, 64, 64))
+    net = _embedding_net(backbone, engine, 1, (3, 64, 64))
+    images = torch.randn(2, 3, 64, 64)
+    reference, _ = reference_net._embed(images, evaluation=False)
+    embeddings, _ = net._embed(images, evaluation=False)
+    scale = max(1.0, reference.abs().max().item())
+    torch.testing.assert_close(embeddings, reference, rtol=0, atol=1e-5 * scale)
+
+
+def test_grouped_conv_weight_matches_the_patch_map():
+    torch.manual_seed(0)
+    input_dim, patchsize = 4, 3
+    block = 2 * patchsize ** 2
+    # Two outputs per pair of channels, like MeanMapper, and an all-zero row.
+    matrix = torch.zeros(5, input_dim * patchsize ** 2, dtype=torch.float64)
+    matrix[2:4, :block] = torch.randn(2, block, dtype=torch.float64)
+    matrix[0:2, block:] = torch.randn(2, block, dtype=torch.float64)
+    weight, groups, outputs = common.grouped_conv_weight(matrix, input_dim, patchsize)
+    assert groups == 2
+    assert outputs.tolist() == [2, 3, 0, 1]
+
+    features = torch.randn(2, input_dim, 6, 7, dtype=torch.float64)
+    convolved = torch.nn.functional.conv2d(features, weight, groups=groups, padding=patchsize // 2)
+    # Flattened (channel, patch row, patch column) patches, as made by PatchMaker.
+    patches = torch.nn.functional.unfold(features, patchsize, padding=patchsize // 2)
+    expected = (matrix[outputs] @ patches).reshape(2, len(outputs), 6, 7)
+    torch.testing.assert_close(convolved, expected)
+
+
+def test_feature_caches_sharing_a_spill_dir_keep_their_own_entries(tmp_path):
+    caches = [common.FeatureCache(0, str(tmp_path)) for _ in range(2)]
+    for value, cache in enumerate(caches):
+        cache.put("image.png", torch.full((4, 3), float(value)))
+
+    assert caches[0].spill_dir != caches[1].spill_dir
+    for value, cache in enumerate(caches):
+        assert torch.equal(cache.get("image.png"), torch.full((4, 3), float(value)))
+
+
+def test_feature_cache_clear_removes_its_spill_dir(tmp_path):
+    cache = common.FeatureCache(0, str(tmp_path))
+    cache.put("image.png", torch.zeros(4, 3))
+    cache.clear()
+
+    assert "image.png" not in cache
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    "patch_shape, size",
+    [
+        ((36, 36), (288, 288)),
+        ((28, 28), 224),
+        ((7, 11), (64, 90)),  # non-square, non-integer scale
+        ((20, 20), (15, 12)),  # downsampling
+        ((1, 1), (8, 8)),
+    ],
+)
+def test_resize_and_blur_matches_interpolate_then_scipy(patch_shape, size):
+    scores = np.random.RandomState(0).rand(3, *patch_shape)
+    interpolated = torch.nn.functional.interpolate(
+        torch.from_numpy(scores).unsqueeze(1), size=size, mode="bilinear", align_corners=False
+    ).squeeze(1).numpy()
+    expected = np.stack([ndimage.gaussian_filter(image, sigma=4) for image in interpolated])
+    fused = common.resize_and_blur(torch.from_numpy(scores), size, sigma=4).numpy()
+    np.testing.assert_allclose(fused, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_rescale_segmentor_matches_interpolate_then_scipy():
+    scores = np.random.RandomState(1).rand(2, 36, 36).astype(np.float32)
+    segmentor = common.RescaleSegmentor(device=torch.device("cpu"), target_size=(288, 288))
+    segmentations, _ = segmentor.convert_to_segmentation(scores)
+
+    interpolated = torch.nn.functional.interpolate(
+        torch.from_numpy(scores).unsqueeze(1), size=(288, 288), mode="bilinear", align_corners=False
+    ).squeeze(1).numpy()
+    expected = [ndimage.gaussian_filter(image, sigma=4) for image in interpolated]
+    np.testing.assert_allclose(np.stack(segmentations), np.stack(expected), rtol=1e-4, atol=1e-6)
+
+
+def test_aggregators_leave_a_shared_backbone_unchanged():
+    import resnet
+
+    torch.manual_seed(0)
+    backbone = resnet.resnet18(False).eval()
+    weights = {key: value.clone() for key, value in backbone.state_dict().items()}
+    images = torch.randn(2, 3, 64, 64)
+    device = torch.device("cpu")
+
+    exiting = common.NetworkFeatureAggregator(backbone, ["layer1", "layer2.0"], device)
+    expected = {key: value.clone() for key, value in exiting(images).items()}
+    pruned = common.NetworkFeatureAggregator(
+        backbone, ["layer1", "layer2.0"], device, truncate="prune"
+    )
+    pruned.set_inference_mode(channels_last=True)
+    features = pruned(images)
+    full = common.NetworkFeatureAggregator(backbone, ["layer4"], device, truncate="none")
+
+    assert isinstance(pruned.backbone.layer3, torch.nn.Identity)
+    assert isinstance(pruned.backbone.layer2[1], torch.nn.Identity)
+    assert pruned.backbone.layer2[0] is backbone.layer2[0]
+    assert not any(isinstance(module, torch.nn.Identity) for module in backbone.modules())
+    assert backbone.conv1.weight.is_contiguous()
+    for key, value in backbone.state_dict().items():
+        assert torch.equal(value, weights[key]), key
+    for layer in expected:
+        torch.testing.assert_close(features[layer], expected[layer])
+    assert full(images)["layer4"].shape == (2, 512, 2, 2)
+    for layer, value in exiting(images).items():
+        assert torch.equal(value, expected[layer]), layer
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import metrics
+
+
+def _segmentations(n_images=6, height=40, width=32, seed=0):
+    rng = np.random.RandomState(seed)
+    segmentations = rng.rand(n_images, height, width).astype(np.float32)
+    segmentations *= np.linspace(0.5, 3, n_images, dtype=np.float32).reshape(-1, 1, 1)
+    segmentations += np.linspace(-1, 1, n_images, dtype=np.float32).reshape(-1, 1, 1)
+    flat = segmentations.reshape(n_images, -1)
+    return segmentations, flat.min(axis=-1), flat.max(axis=-1)
+
+
+def test_mean_affine_normalization_matches_legacy():
+    segmentations, min_scores, max_scores = _segmentations()
+    legacy = metrics.normalize_segmentations_legacy(
+        segmentations, min_scores.reshape(-1, 1, 1), max_scores.reshape(-1, 1, 1)
+    )
+    normalized = metrics.normalize_segmentations(segmentations, min_scores, max_scores, "mean_affine")
+    assert normalized.dtype == segmentations.dtype
+    np.testing.assert_allclose(normalized, legacy, rtol=1e-5, atol=1e-6)
+
+
+def test_mean_affine_normalization_matches_legacy_for_flat_maps():
+    segmentations, min_scores, max_scores = _segmentations()
+    # A constant map has a range below the 1e-2 floor.
+    segmentations[2] = 0.5
+    min_scores[2] = max_scores[2] = 0.5
+    legacy = metrics.normalize_segmentations_legacy(
+        segmentations, min_scores.reshape(-1, 1, 1), max_scores.reshape(-1, 1, 1)
+    )
+    normalized = metrics.normalize_segmentations(segmentations, min_scores, max_scores)
+    np.testing.assert_allclose(normalized, legacy, rtol=1e-5, atol=1e-6)
+
+
+def test_per_image_normalization_uses_the_extrema_of_every_image():
+    segmentations, min_scores, max_scores = _segmentations()
+    normalized = metrics.normalize_segmentations(segmentations, min_scores, max_scores, "per_image")
+    flat = normalized.reshape(len(normalized), -1)
+    np.testing.assert_allclose(flat.min(axis=-1), 0, atol=1e-6)
+    np.testing.assert_allclose(flat.max(axis=-1), 1, atol=1e-6)
+
+
+def test_global_normalization_uses_the_extrema_of_the_stack():
+    segmentations, min_scores, max_scores = _segmentations()
+    normalized = metrics.normalize_segmentations(segmentations, min_scores, max_scores, "global")
+    assert normalized.min() == pytest.approx(0, abs=1e-6)
+    assert normalized.max() == pytest.approx(1, abs=1e-6)
+
+
+def test_unknown_normalization_raises():
+    segmentations, min_scores, max_scores = _segmentations()
+    with pytest.raises(ValueError):
+        metrics.normalize_segmentations(segmentations, min_scores, max_scores, "per_pixel")
+
+
+def _pro_inputs(n_images=5, size=48, seed=0, max_regions=3):
+    """Smooth anomaly maps and box-shaped masks, some of them empty."""
+    rng = np.random.RandomState(seed)
+    amaps = rng.rand(n_images, size, size).astype(np.float32)
+    masks = np.zeros_like(amaps)
+    for mask, amap in zip(masks, amaps):
+        for _ in range(rng.randint(0, max_regions + 1)):
+            y, x = rng.randint(0, size * 3 // 4, 2)
+            h, w = rng.randint(3, size // 4, 2)
+            mask[y:y + h, x:x + w] = 1
+            amap[y:y + h, x:x + w] += rng.rand() * 0.5
+    return masks, amaps
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_compute_pro_matches_legacy(seed):
+    masks, amaps = _pro_inputs(seed=seed)
+    expected = metrics.compute_pro_legacy(masks, amaps, num_th=200)
+    assert metrics.compute_pro(masks, amaps, num_th=200) == pytest.approx(expected, abs=1e-10)
+
+
+def test_compute_pro_matches_legacy_with_empty_masks():
+    masks, amaps = _pro_inputs(seed=3)
+    masks[::2] = 0
+    expected = metrics.compute_pro_legacy(masks, amaps, num_th=50)
+    assert metrics.compute_pro(masks, amaps, num_th=50) == pytest.approx(expected, abs=1e-10)
+
+
+def test_compute_pro_matches_legacy_for_a_single_region():
+    masks, amaps = _pro_inputs(n_images=3, seed=4, max_regions=0)
+    masks[1, 10:20, 5:30] = 1
+    amaps[1, 12:22, 5:25] += 0.3
+    expected = metrics.compute_pro_legacy(masks, amaps, num_th=50)
+    assert metrics.compute_pro(masks, amaps, num_th=50) == pytest.approx(expected, abs=1e-10)
+
+
+def test_compute_pro_matches_legacy_for_touching_regions_and_borders():
+    masks, amaps = _pro_inputs(n_images=2, seed=5, max_regions=0)
+    # Regions at the border, touching diagonally and of a single pixel.
+    masks[0, :6, :6] = 1
+    masks[0, 6:12, 6:12] = 1
+    masks[1, -1, -1] = 1
+    masks[1, 20:30, 0] = 1
+    expected = metrics.compute_pro_legacy(masks, amaps, num_th=50)
+    assert metrics.compute_pro(masks, amaps, num_th=50) == pytest.approx(expected, abs=1e-10)
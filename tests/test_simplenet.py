@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import PIL.Image
+import pytest
+import torch
+
+import resnet
+import simplenet
+from datasets import mvtec
+
+
+@pytest.fixture
+def mvtec_root(tmp_path):
+    """A tiny MVTec-style class "toy" with random images."""
+    rng = np.random.RandomState(0)
+    root = tmp_path / "mvtec"
+    folders = {
+        "train/good": 4,
+        "test/good": 2,
+        "test/broken": 2,
+    }
+    for folder, n_images in folders.items():
+        os.makedirs(str(root / "toy" / folder))
+        for i in range(n_images):
+            image = rng.randint(0, 256, (40, 40, 3), dtype=np.uint8)
+            PIL.Image.fromarray(image).save(str(root / "toy" / folder / "{:03d}.png".format(i)))
+    os.makedirs(str(root / "toy" / "ground_truth" / "broken"))
+    for i in range(folders["test/broken"]):
+        mask = np.zeros((40, 40), dtype=np.uint8)
+        mask[10:20, 10 + 5 * i:25 + 5 * i] = 255
+        PIL.Image.fromarray(mask).save(
+            str(root / "toy" / "ground_truth" / "broken" / "{:03d}_mask.png".format(i))
+        )
+    return str(root)
+
+
+def _dataloaders(mvtec_root):
+    def dataset(split):
+        return mvtec.MVTecDataset(mvtec_root, "toy", resize=36, imagesize=32, split=split)
+
+    training = torch.utils.data.DataLoader(
+        dataset(mvtec.DatasetSplit.TRAIN), batch_size=2, shuffle=True
+    )
+    training.name = "mvtec_toy"
+    testing = torch.utils.data.DataLoader(dataset(mvtec.DatasetSplit.TEST), batch_size=2)
+    return training, testing
+
+
+def _simplenet(model_dir, **kwargs):
+    torch.manual_seed(0)
+    backbone = resnet.resnet18(False)
+    backbone.name, backbone.seed = "resnet18", None
+    net = simplenet.SimpleNet(torch.device("cpu"))
+    net.load(
+        backbone=backbone,
+        layers_to_extract_from=["layer2", "layer3"],
+        device=torch.device("cpu"),
+        input_shape=(3, 32, 32),
+        pretrain_embed_dimension=64,
+        target_embed_dimension=64,
+        meta_epochs=3,
+        gan_epochs=1,
+        dsc_hidden=32,
+        pre_proj=1,
+        tensorboard=False,
+        **kwargs
+    )
+    net.set_model_dir(model_dir, "mvtec_toy")
+    return net
+
+
+def _assert_equal(expected, actual, path="state"):
+    if isinstance(expected, torch.Tensor):
+        assert torch.equal(expected, actual), path
+    elif isinstance(expected, dict):
+        assert expected.keys() == actual.keys(), path
+        for key in expected:
+            _assert_equal(expected[key], actual[key], "{}[{!r}]".format(path, key))
+    elif isinstance(expected, (list, tuple)):
+        assert len(expected) == len(actual), path
+        for i, (a, b) in enumerate(zip(expected, actual)):
+            _assert_equal(a, b, "{}[{}]".format(path, i))
+    else:
+        assert expected == actual, path
+
+
+def test_resumed_training_matches_an_uninterrupted_run(mvtec_root, tmp_path, monkeypatch):
+    training, testing = _dataloaders(mvtec_root)
+    uninterrupted = _simplenet(str(tmp_path / "uninterrupted"))
+    uninterrupted.train(training, testing)
+
+    interrupted = _simplenet(str(tmp_path / "resumed"))
+    train_discriminator = interrupted._train_discriminator
+    calls = []
+
+    def interrupt_in_second_epoch(data):
+        calls.append(data)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return train_discriminator(data)
+
+    monkeypatch.setattr(interrupted, "_train_discriminator", interrupt_in_second_epoch)
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.train(training, testing)
+    train_state_path = os.path.join(interrupted.ckpt_dir, "train_state.pth")
+    assert torch.load(train_state_path)["meta_epoch"] == 1
+
+    resumed = _simplenet(str(tmp_path / "resumed"), resume=True)
+    resumed.train(training, testing)
+
+    expected = torch.load(os.path.join(uninterrupted.ckpt_dir, "train_state.pth"))
+    actual = torch.load(train_state_path)
+    assert actual["meta_epoch"] == 3
+    for key in ("modules", "optimizers", "dsc_schl", "g_iter", "rng", "best_record"):
+        _assert_equal(expected[key], actual[key], key)
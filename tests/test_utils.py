@@ -0,0 +1,30 @@
+import os
+
+import torch
+
+import utils
+
+
+def test_checkpoint_writer_prunes_snapshots_of_an_earlier_run(tmp_path):
+    for filename in ("ckpt_2.pth", "ckpt_10.pth", "ckpt_int8.pth", "best.pth"):
+        torch.save({}, str(tmp_path / filename))
+
+    writer = utils.CheckpointWriter(str(tmp_path), keep_last=2)
+    writer.snapshot({"step": 11}, 11)
+    writer.close()
+
+    assert sorted(os.listdir(str(tmp_path))) == [
+        "best.pth", "ckpt_10.pth", "ckpt_11.pth", "ckpt_int8.pth"
+    ]
+
+
+def test_checkpoint_writer_overwrites_a_snapshot_only_once(tmp_path):
+    torch.save({}, str(tmp_path / "ckpt_1.pth"))
+
+    writer = utils.CheckpointWriter(str(tmp_path), keep_last=2)
+    writer.snapshot({"step": 1}, 1)
+    writer.snapshot({"step": 2}, 2)
+    writer.close()
+
+    assert sorted(os.listdir(str(tmp_path))) == ["ckpt_1.pth", "ckpt_2.pth"]
+    assert torch.load(str(tmp_path / "ckpt_1.pth")) == {"step": 1}
@@ -1,7 +1,10 @@
 import csv
 import logging
 import os
+import queue
 import random
+import re
+import threading
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -173,3 +176,202 @@ def compute_and_store_final_results(
 
     mean_metrics = {"mean_{0}".format(key): item for key, item in mean_metrics.items()}
     return mean_metrics
+
+
+class CheckpointWriter:
+    """Writes checkpoints from a background thread.
+
+    Snapshots handed to the writer must not be modified afterwards, so pass
+    CPU copies of the state dicts. Every file is first written to a
+    temporary name and then renamed, so a crash never leaves a truncated
+    checkpoint behind. At most max_pending snapshots wait in the queue;
+    further calls block until the writer catches up.
+    """
+
+    def __init__(self, directory, keep_last=0, max_pending=2, best_name="best.pth"):
+        """
+        Args:
+            directory: [str] Folder the checkpoints are written to.
+            keep_last: [int] Number of tagged snapshots to retain, 0 keeps
+                       none and only updates best_name.
+            max_pending: [int] Maximal number of queued snapshots.
+            best_name: [str] Filename of the best snapshot.
+        """
+        self.directory = directory
+        self.keep_last = keep_last
+        self.best_name = best_name
+        self._snapshots = self._existing_snapshots(directory)
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _existing_snapshots(directory):
+        """Returns the ckpt_{meta epoch}.pth files of an earlier run, oldest first.
+
+        They count towards keep_last, so that a resumed run prunes them too.
+        """
+        if not os.path.isdir(directory):
+            return []
+        tags = []
+        for filename in os.listdir(directory):
+            match = re.fullmatch(r"ckpt_(\d+)\.pth", filename)
+            if match is not None:
+                tags.append(int(match.group(1)))
+        return ["ckpt_{}.pth".format(tag) for tag in sorted(tags)]
+
+    def _write(self, state, filename):
+        path = os.path.join(self.directory, filename)
+        torch.save(state, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                state, filenames, snapshot = job
+                for filename in filenames:
+                    self._write(state, filename)
+                if snapshot is not None:
+                    if snapshot in self._snapshots:
+                        self._snapshots.remove(snapshot)
+                    self._snapshots.append(snapshot)
+                    while len(self._snapshots) > self.keep_last:
+                        os.remove(os.path.join(self.directory, self._snapshots.pop(0)))
+            except Exception as error:
+                LOGGER.exception("Writing checkpoint failed.")
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _submit(self, state, filenames, snapshot=None):
+        if self._error is not None:
+            raise RuntimeError("A previous checkpoint could not be written.") from self._error
+        self._queue.put((state, filenames, snapshot))
+
+    def snapshot(self, state, tag, is_best=False):
+        """Queues state as ckpt_{tag}.pth (if keep_last > 0) and as best if is_best."""
+        filenames = []
+        snapshot = None
+        if self.keep_last > 0:
+            snapshot = "ckpt_{}.pth".format(tag)
+            filenames.append(snapshot)
+        if is_best:
+            filenames.append(self.best_name)
+        if filenames:
+            self._submit(state, filenames, snapshot)
+
+    def save(self, state, filename):
+        """Queues state to be written as filename."""
+        self._submit(state, [filename])
+
+    def close(self, raise_errors=True):
+        """Waits for all queued checkpoints to be written.
+
+        Raises if one could not be written, unless raise_errors is False
+        (the error has been logged by the writer already).
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if raise_errors and self._error is not None:
+            raise RuntimeError("A checkpoint could not be written.") from self._error
+
+
+class EarlyStopping:
+    """Counts evaluations without improvement, patience 0 never stops."""
+
+    def __init__(self, patience=0):
+        self.patience = patience
+        self.stale_evaluations = 0
+
+    def step(self, improved):
+        """Records an evaluation and returns whether training should stop."""
+        self.stale_evaluations = 0 if improved else self.stale_evaluations + 1
+        return 0 < self.patience <= self.stale_evaluations
+
+    def state_dict(self):
+        return {"stale_evaluations": self.stale_evaluations}
+
+    def load_state_dict(self, state_dict):
+        self.stale_evaluations = state_dict["stale_evaluations"]
+
+
+class MetricsBuffer:
+    """Per-step training scalars that stay on the device until they are flushed.
+
+    log() stores the values of a step without synchronizing with the device.
+    Every flush_every steps the stored rows are copied to the host without
+    blocking and written to writer (anything with add_scalar(tag, value,
+    step), or None) once the copy has landed, at the next flush or at
+    close().
+    """
+
+    def __init__(self, names, device, writer=None, flush_every=50):
+        self.names = list(names)
+        self.device = torch.device(device)
+        self.writer = writer
+        self.flush_every = flush_every
+        self.buffer = torch.zeros(flush_every, len(self.names), device=self.device)
+        self.host = torch.zeros(
+            flush_every, len(self.names), pin_memory=self.device.type == "cuda"
+        )
+        self.steps = []
+        self.pending = None
+        self.sums = torch.zeros(len(self.names), device=self.device)
+        self.count = 0
+
+    def log(self, step, *values):
+        """Stores one value per name, device tensors or numbers, for step."""
+        row = torch.stack([
+            torch.as_tensor(value, device=self.device).detach().to(torch.float32).reshape(())
+            for value in values
+        ])
+        self.sums += row
+        self.count += 1
+        if self.writer is None:
+            return
+        self.buffer[len(self.steps)] = row
+        self.steps.append(step)
+        if len(self.steps) == self.flush_every:
+            self.flush()
+
+    def _write_pending(self):
+        if self.pending is None:
+            return
+        event, steps = self.pending
+        if event is not None:
+            event.synchronize()
+        for step, row in zip(steps, self.host[:len(steps)].tolist()):
+            for name, value in zip(self.names, row):
+                self.writer.add_scalar(name, value, step)
+        self.pending = None
+
+    def flush(self):
+        """Starts copying the stored rows to the host, after writing the previous copy."""
+        self._write_pending()
+        if not self.steps:
+            return
+        n_steps = len(self.steps)
+        self.host[:n_steps].copy_(self.buffer[:n_steps], non_blocking=True)
+        event = None
+        if self.device.type == "cuda":
+            event = torch.cuda.Event()
+            event.record()
+        self.pending = (event, self.steps)
+        self.steps = []
+
+    def means(self):
+        """Returns the mean of every metric since the last call, synchronizing once."""
+        means = (self.sums / max(self.count, 1)).tolist()
+        self.sums.zero_()
+        self.count = 0
+        return dict(zip(self.names, means))
+
+    def close(self):
+        self.flush()
+        self._write_pending()